@@ -1,8 +1,15 @@
 import os
 import fire
+import numpy as np
 import pandas as pd
 from typing import List
-from tqdm import tqdm
+
+try:
+    from py_scripts.schema import apply_schema
+    from py_scripts.tariff_cube import dedupe_tariffs
+except ImportError:
+    from schema import apply_schema
+    from tariff_cube import dedupe_tariffs
 
 # Пара код страны, год вхождения в EU
 EU = [
@@ -15,15 +22,34 @@ EU = [
 EU_DICT = {key: val for key, val in EU}
 
 
-def code_to_reporter(item):
-    code = item.code
-    current_year = item.current_year
+def code_to_reporter(codes: pd.Series, years: pd.Series) -> np.ndarray:
+    """
+    Векторно переводит коды стран в коды репортеров тарифов: страны EU после
+    года вступления заменяются кодом 918. Таблица (код страны × год) строится
+    один раз по уникальным значениям, строки разрешаются индексированием массива.
+    """
+    code_idx, code_values = pd.factorize(codes)
+    year_idx, year_values = pd.factorize(years)
+
+    entry_years = np.array([EU_DICT.get(code, np.iinfo(np.int64).max) for code in code_values])
+    lookup = np.where(
+        np.asarray(year_values)[None, :] >= entry_years[:, None],
+        918,
+        np.asarray(code_values)[:, None]
+    )
+    return lookup[code_idx, year_idx]
+
 
-    if code in EU_DICT.keys():
-        entry_year = EU_DICT[code]
-        if current_year >= entry_year:
-            return 918
-    return code
+def cross_join_years(weights: pd.DataFrame, years_of_interest: List[int]) -> pd.DataFrame:
+    """
+    Размножает таблицу весов на все годы (год за годом, как при конкатенации)
+    и проставляет Reporter_ISO_N для каждой пары (страна, год)
+    """
+    years = np.asarray(years_of_interest)
+    n_rows = len(weights)
+    return weights.iloc[np.tile(np.arange(n_rows), len(years))]\
+            .assign(current_year=np.repeat(years, n_rows))\
+            .assign(Reporter_ISO_N=lambda x: code_to_reporter(x["code"], x["current_year"]))
 
 
 def prepare_instrument_table(
@@ -31,25 +57,14 @@ def prepare_instrument_table(
         tariffs: pd.DataFrame,
         years_of_interest: List[int] = [2005, 2006, 2007, 2008, 2009]
 ) -> pd.DataFrame:
-    result = []
-    for year in years_of_interest:
-        df = weights.assign(
-            current_year=year,
-            Reporter_ISO_N=lambda x: x.apply(code_to_reporter, axis=1)
-        )
-        result.append(df)
-
-    result = pd.concat(result)
-
-    df = result.merge(tariffs, on=["Reporter_ISO_N", "ProductCode", "current_year"], how="left")
+    result = cross_join_years(weights, years_of_interest)
 
-    result = []
-    for _, item_df in tqdm(df.groupby(["code", "product"])):
-        item_df = item_df.sort_values(by=["current_year"])\
-                    .assign(SimpleAverage=lambda x: x.SimpleAverage.ffill())
-        result.append(item_df)
+    # Повторы ключа усредняются, как в кубе тарифов, чтобы merge не размножал строки
+    df = result.merge(dedupe_tariffs(tariffs), on=["Reporter_ISO_N", "ProductCode", "current_year"], how="left")
 
-    df = pd.concat(result)
+    # Протягиваем тарифы вперед внутри пары (страна, товар)
+    df = df.sort_values(by=["code", "product", "current_year"], kind="stable")\
+            .assign(SimpleAverage=lambda x: x.groupby(["code", "product"])["SimpleAverage"].ffill())
 
     cols = [
         "okved_four",
@@ -71,11 +86,12 @@ def prepare_instrument_table(
 
 
 def main(weights_path: str, tariffs_path: str, output_path: str):
-    weights = pd.read_parquet(weights_path)\
-            .assign(ProductCode=lambda x: x["product"].astype(int))
-    tariffs = pd.read_parquet(tariffs_path)
+    weights = apply_schema(pd.read_parquet(weights_path), name="weights")\
+            .assign(ProductCode=lambda x: x["product"].astype("int32"))
+    tariffs = apply_schema(pd.read_parquet(tariffs_path), name="tariffs")
 
     result = prepare_instrument_table(weights=weights, tariffs=tariffs)
+    result = apply_schema(result, name="instrument")
     result.to_parquet(output_path, index=False)
 
 
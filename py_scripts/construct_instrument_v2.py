@@ -1,10 +1,27 @@
 import os
 import fire
+import numpy as np
 import pandas as pd
-from typing import List
-from tqdm import tqdm
+from scipy import sparse
+from typing import List, NamedTuple, Optional, Tuple
+
+try:
+    from py_scripts.incremental import parse_years, replace_years
+    from py_scripts.panel_utils import panel_lag
+    from py_scripts.process_raw_customs import read_gtd
+    from py_scripts.sampling import read_parquet_sample
+    from py_scripts.schema import apply_schema
+    from py_scripts.tariff_cube import TariffCube, build_tariff_cube, ffill_last_axis, load_tariff_cube, lookup_tariffs, lookup_avg_tariff
+except ImportError:
+    from incremental import parse_years, replace_years
+    from panel_utils import panel_lag
+    from process_raw_customs import read_gtd
+    from sampling import read_parquet_sample
+    from schema import apply_schema
+    from tariff_cube import TariffCube, build_tariff_cube, ffill_last_axis, load_tariff_cube, lookup_tariffs, lookup_avg_tariff
 
 SPARK_COLS = ["INN", "okved_four", "year"]
+CUSTOMS_COLS = ["INN", "year", "code", "product", "value"]
 
 # Пара код страны, год вхождения в EU
 EU = [
@@ -17,59 +34,143 @@ EU = [
 EU_DICT = {key: val for key, val in EU}
 
 
-def code_to_reporter(item):
-    code = item.code
-    current_year = item.current_year
+def code_to_reporter(codes: pd.Series, years: pd.Series) -> np.ndarray:
+    """
+    Векторно переводит коды стран в коды репортеров тарифов: страны EU после
+    года вступления заменяются кодом 918. Таблица (код страны × год) строится
+    один раз по уникальным значениям, строки разрешаются индексированием массива.
+    """
+    code_idx, code_values = pd.factorize(codes)
+    year_idx, year_values = pd.factorize(years)
+
+    entry_years = np.array([EU_DICT.get(code, np.iinfo(np.int64).max) for code in code_values])
+    lookup = np.where(
+        np.asarray(year_values)[None, :] >= entry_years[:, None],
+        918,
+        np.asarray(code_values)[:, None]
+    )
+    return lookup[code_idx, year_idx]
 
-    if code in EU_DICT.keys():
-        entry_year = EU_DICT[code]
-        if current_year >= entry_year:
-            return 918
-    return code
 
+def cross_join_years(weights: pd.DataFrame, years_of_interest: List[int]) -> pd.DataFrame:
+    """
+    Размножает таблицу весов на все годы (год за годом, как при конкатенации)
+    и проставляет Reporter_ISO_N для каждой пары (страна, год)
+    """
+    years = np.asarray(years_of_interest)
+    n_rows = len(weights)
+    return weights.iloc[np.tile(np.arange(n_rows), len(years))]\
+            .assign(current_year=np.repeat(years, n_rows))\
+            .assign(Reporter_ISO_N=lambda x: code_to_reporter(x["code"], x["current_year"]))
 
-def prepare_weights(
+
+class Scenario(NamedTuple):
+    base_year: int = 2005
+    # Порог стоимости поставки (value > min_value), None - без порога
+    min_value: Optional[float] = None
+    # "country" - веса по странам; "eu_block" - страны EU базового года как один партнер 918
+    weighting: str = "country"
+
+    @property
+    def scenario_id(self) -> str:
+        return "{base_year}_{min_value}_{weighting}".format(
+            base_year=self.base_year,
+            min_value=0 if self.min_value is None else int(self.min_value),
+            weighting=self.weighting
+        )
+
+
+WEIGHTINGS = ["country", "eu_block"]
+
+
+def merge_customs_spark(
         spark_path: str,
         customs_path: str,
-        tariffs_df: pd.DataFrame
-):
-    spark_df = pd.read_parquet(spark_path)\
+        base_years: List[int],
+        sample_fraction: Optional[float] = None
+) -> pd.DataFrame:
+    """
+    Таможенные поставки базовых лет с ОКВЭД фирмы из Spark
+    :return: таблица INN, year, code, product, value, okved_four
+    """
+    spark_df = apply_schema(read_parquet_sample(spark_path, sample_fraction=sample_fraction), name="spark")\
                 .rename(columns={"Year": "year"})
-    customs_df = pd.read_parquet(customs_path)
+    customs_df = apply_schema(
+        read_gtd(customs_path, years=base_years, columns=CUSTOMS_COLS, sample_fraction=sample_fraction),
+        name="customs"
+    )
 
     # Filtering
     spark_df = spark_df\
-            .loc[(spark_df["year"] == 2005) & (~spark_df["okved_four"].isin(['nan', 'None'])), SPARK_COLS]
+            .loc[spark_df["year"].isin(base_years) & spark_df["okved_four"].notnull() & (~spark_df["okved_four"].isin(['nan', 'None'])), SPARK_COLS]
     customs_df = customs_df.loc[(~customs_df["product"].isnull())]
     print(len(spark_df), len(customs_df))
 
     # Form the dataset
-    df = pd.merge(customs_df, spark_df, on=["INN", "year"], how="inner")
-    df = df.groupby(["okved_four", "product", "code"]).agg({"value": "sum"}).reset_index()\
-            .assign(
-                ProductCode=lambda x: x["product"].astype(int),
-                current_year=2005,
-                Reporter_ISO_N=lambda x: x.apply(code_to_reporter, axis=1),
-            )
+    return pd.merge(customs_df, spark_df, on=["INN", "year"], how="inner")
+
+
+def aggregate_flows(
+        merged: pd.DataFrame,
+        *,
+        base_year: int = 2005,
+        min_value: Optional[float] = None
+) -> pd.DataFrame:
+    """
+    Суммарные поставки по (okved_four, product, code) за базовый год
+    """
+    df = merged.loc[merged["year"] == base_year]
+    if min_value is not None:
+        df = df.loc[df["value"] > min_value]
+    return df.groupby(["okved_four", "product", "code"], observed=True).agg({"value": "sum"}).reset_index()
+
+
+def compute_weights(
+        flows: pd.DataFrame,
+        cube: TariffCube,
+        *,
+        base_year: int = 2005,
+        weighting: str = "country"
+) -> pd.DataFrame:
+    """
+    Веса товаров и стран внутри ОКВЭД по поставкам базового года
+    :param flows: результат aggregate_flows
+    :param cube: куб тарифов
+    :param base_year: базовый год
+    :param weighting: "country" или "eu_block"
+    :return: таблица весов
+    """
+    if weighting not in WEIGHTINGS:
+        raise ValueError("Unknown weighting: {weighting}".format(weighting=weighting))
+
+    df = flows
+    if weighting == "eu_block":
+        # Страны EU базового года объединяются в одного партнера с кодом 918
+        df = df.assign(code=lambda x: code_to_reporter(x["code"], np.full(len(x), base_year)).astype(x["code"].dtype))\
+                .groupby(["okved_four", "product", "code"], observed=True).agg({"value": "sum"}).reset_index()
+
+    df = df.assign(
+        ProductCode=lambda x: x["product"].astype(int),
+        current_year=base_year,
+        Reporter_ISO_N=lambda x: code_to_reporter(x["code"], x["current_year"]),
+    )
     print(len(df))
 
-    df = df.merge(
-        tariffs_df.loc[tariffs_df["current_year"] == 2005,["Reporter_ISO_N", "ProductCode", "SimpleAverage"]],
-        on=["Reporter_ISO_N", "ProductCode"],
-        how="inner"
-    ).dropna(subset=["SimpleAverage"]).drop(columns="SimpleAverage")
+    # Оставляем пары, для которых есть тариф базового года
+    base_tariff = lookup_tariffs(cube, df["Reporter_ISO_N"], df["ProductCode"], df["current_year"])
+    df = df.loc[~np.isnan(base_tariff)]
 
     print(len(df))
 
     # Aggregate weights by okved
-    agg_df = df.groupby(["okved_four"]).agg({"value": "sum"})\
+    agg_df = df.groupby(["okved_four"], observed=True).agg({"value": "sum"})\
                 .reset_index().rename(columns={"value": "value_agg"})
     df = df.merge(agg_df, on=["okved_four"], how="inner")\
             .assign(weight=lambda x: x.value / x.value_agg)\
             .drop(columns=["value_agg"])
 
     # Aggregate weights by okved and country code
-    agg_df = df.groupby(["okved_four", "code"]).agg({"value": "sum"})\
+    agg_df = df.groupby(["okved_four", "code"], observed=True).agg({"value": "sum"})\
                 .reset_index().rename(columns={"value": "value_agg"})
     df = df.merge(agg_df, on=["okved_four", "code"], how="inner")\
             .assign(weight_c=lambda x: x.value / x.value_agg)\
@@ -78,30 +179,57 @@ def prepare_weights(
     return df
 
 
+def prepare_weights(
+        spark_path: str,
+        customs_path: str,
+        cube: TariffCube,
+        sample_fraction: Optional[float] = None
+):
+    merged = merge_customs_spark(spark_path, customs_path, base_years=[2005], sample_fraction=sample_fraction)
+    return compute_weights(aggregate_flows(merged, base_year=2005), cube, base_year=2005)
+
+
+def build_tariff_matrix(
+        pairs: pd.DataFrame,
+        cube: TariffCube,
+        years_of_interest: List[int]
+) -> np.ndarray:
+    """
+    Плотная матрица тарифов (товар, страна) × год. Репортер определяется
+    для каждого года отдельно, поэтому пропуски протягиваются вперед внутри
+    пары (страна, товар), а не внутри репортера: страна может перейти в EU
+    :param pairs: уникальные пары с колонками code, ProductCode
+    :param cube: куб тарифов
+    :param years_of_interest: годы
+    :return: массив размера len(pairs) × len(years_of_interest)
+    """
+    grid = cross_join_years(pairs[["code", "ProductCode"]], years_of_interest)
+    matrix = lookup_tariffs(cube, grid["Reporter_ISO_N"], grid["ProductCode"], grid["current_year"])\
+            .reshape(len(years_of_interest), len(pairs)).T
+    return ffill_last_axis(matrix)
+
+
 def prepare_instrument_table(
         weights: pd.DataFrame,
-        tariffs: pd.DataFrame,
-        years_of_interest: List[int] = [2005, 2006, 2007, 2008, 2009]
+        cube: TariffCube,
+        years_of_interest: List[int],
+        output_years: Optional[List[int]] = None
 ) -> pd.DataFrame:
-    result = []
-    for year in years_of_interest:
-        df = weights.assign(
-            current_year=year,
-            Reporter_ISO_N=lambda x: x.apply(code_to_reporter, axis=1)
-        )
-        result.append(df)
-
-    result = pd.concat(result)
+    """
+    :param output_years: годы, для которых строится таблица (по умолчанию все);
+        тарифы протягиваются вперед по всем years_of_interest
+    """
+    output_years = years_of_interest if output_years is None else output_years
+    result = cross_join_years(weights, output_years)
 
-    df = result.merge(tariffs, on=["Reporter_ISO_N", "ProductCode", "current_year"], how="left")
+    # Тарифы берутся из матрицы уникальных пар (страна, товар) × год
+    pair_idx = weights.groupby(["product", "code"], sort=False).ngroup().to_numpy()
+    pairs = weights.drop_duplicates(subset=["product", "code"])
+    tariff = build_tariff_matrix(pairs, cube, years_of_interest)
+    year_idx = np.repeat([list(years_of_interest).index(year) for year in output_years], len(weights))
 
-    result = []
-    for _, item_df in tqdm(df.groupby(["code", "product"])):
-        item_df = item_df.sort_values(by=["current_year"])\
-                    .assign(SimpleAverage=lambda x: x.SimpleAverage.ffill())
-        result.append(item_df)
-
-    df = pd.concat(result)
+    present = lookup_tariffs(cube, result["Reporter_ISO_N"], result["ProductCode"], result["current_year"], field="present")
+    avg_tariff = lookup_avg_tariff(cube, result["ProductCode"], result["current_year"])
 
     cols = [
         "okved_four",
@@ -115,35 +243,204 @@ def prepare_instrument_table(
         "avg_tariff"
     ]
 
-    df = df.assign(
+    df = result.assign(
         year=lambda x: x["current_year"],
-        tariff=lambda x: x["SimpleAverage"]
+        tariff=tariff[np.tile(pair_idx, len(output_years)), year_idx],
+        # Средний тариф есть только там, где была строка тарифов
+        avg_tariff=np.where(present, avg_tariff, np.nan)
     )
 
     return df[cols]
 
 
+def build_weight_matrices(weights: pd.DataFrame) -> Tuple[pd.Index, pd.DataFrame, sparse.csr_matrix, sparse.csr_matrix]:
+    """
+    Разреженные матрицы весов okved × (товар, страна) базового года
+    :param weights: результат prepare_weights
+    :return: okved_four по строкам, пары (product, code, ProductCode) по столбцам,
+        матрицы weight и weight_c
+    """
+    okved_idx, okveds = pd.factorize(weights["okved_four"], sort=True)
+    pair_idx = weights.groupby(["product", "code"], sort=False).ngroup().to_numpy()
+    pairs = weights.drop_duplicates(subset=["product", "code"])[["product", "code", "ProductCode"]]
+
+    shape = (len(okveds), len(pairs))
+    to_matrix = lambda col: sparse.csr_matrix((weights[col].to_numpy(dtype=float), (okved_idx, pair_idx)), shape=shape)
+    return okveds, pairs, to_matrix("weight"), to_matrix("weight_c")
+
+
+def compute_instrument_sparse(
+        weights: pd.DataFrame,
+        cube: TariffCube,
+        years_of_interest: List[int],
+        output_years: Optional[List[int]] = None
+) -> pd.DataFrame:
+    """
+    Считает инструмент за все годы одним произведением разреженной матрицы
+    весов на плотную матрицу тарифов, без длинной таблицы okved × товар × год.
+    Результат совпадает с агрегатом prepare_iv_df по длинной таблице
+    :param output_years: годы результата (по умолчанию все years_of_interest)
+    :return: таблица okved_four, year, instrument, instrument_c
+    """
+    okveds, pairs, weight, weight_c = build_weight_matrices(weights)
+    output_years = years_of_interest if output_years is None else output_years
+    # Пропущенные тарифы в сумме по группе не участвуют, как в groupby().sum()
+    tariff = np.nan_to_num(build_tariff_matrix(pairs, cube, years_of_interest))
+    tariff = tariff[:, [list(years_of_interest).index(year) for year in output_years]]
+
+    n_years = len(output_years)
+    return pd.DataFrame({
+        "okved_four": okveds.take(np.repeat(np.arange(len(okveds)), n_years)),
+        "year": np.tile(np.asarray(output_years), len(okveds)),
+        "instrument": (weight @ tariff / 100).ravel(),
+        "instrument_c": (weight_c @ tariff / 100).ravel(),
+    })
+
+
+def parse_scenarios(scenarios: list) -> List[Scenario]:
+    """
+    Конфиги сценариев из командной строки: словари с полями Scenario
+    или кортежи (base_year, min_value, weighting)
+    """
+    result = [Scenario(**item) if isinstance(item, dict) else Scenario(*item) for item in scenarios]
+    ids = [scenario.scenario_id for scenario in result]
+    if len(set(ids)) < len(ids):
+        raise ValueError("Duplicate scenarios: {ids}".format(ids=", ".join(ids)))
+    return result
+
+
+def compute_scenarios(
+        merged: pd.DataFrame,
+        cube: TariffCube,
+        scenarios: List[Scenario],
+        years_of_interest: List[int]
+) -> pd.DataFrame:
+    """
+    Инструмент для нескольких сценариев по одной таблице merge_customs_spark.
+    Поставки агрегируются один раз на пару (base_year, min_value)
+    :return: таблица scenario, okved_four, year, instrument, instrument_c
+    """
+    flows = {}
+    result = []
+    for scenario in scenarios:
+        print("Scenario {scenario_id}".format(scenario_id=scenario.scenario_id))
+        key = (scenario.base_year, scenario.min_value)
+        if key not in flows:
+            flows[key] = aggregate_flows(merged, base_year=scenario.base_year, min_value=scenario.min_value)
+
+        weights = compute_weights(flows[key], cube, base_year=scenario.base_year, weighting=scenario.weighting)
+        result.append(
+            compute_instrument_sparse(weights, cube, years_of_interest)\
+                .assign(scenario=scenario.scenario_id)
+        )
+    return pd.concat(result, ignore_index=True)[["scenario", "okved_four", "year", "instrument", "instrument_c"]]
+
+
 def main(
         spark_path: str,
         customs_path: str,
         tariffs_path: str,
-        output_path: str      
+        output_path: str,
+        engine: str = "long",
+        long_output_path: Optional[str] = None,
+        cube_path: Optional[str] = None,
+        scenarios: Optional[list] = None,
+        sample_fraction: Optional[float] = None,
+        years: Optional[List[int]] = None,
+        weights_path: Optional[str] = None,
+        update_years: Optional[List[int]] = None
 ):
-    tariffs = pd.read_parquet(tariffs_path)
-    tariffs_agg = tariffs.groupby(["ProductCode", "current_year"])["SimpleAverage"].mean()\
-                .reset_index().rename(columns={"SimpleAverage": "avg_tariff"})
-    tariffs = tariffs.merge(tariffs_agg, on=["ProductCode", "current_year"], how="inner")
+    """
+    :param engine: "long" - длинная таблица okved × товар × страна × год (iv.parquet);
+        "sparse" - сразу агрегированный инструмент по (okved_four, year) через матричное произведение
+    :param long_output_path: для engine="sparse" дополнительно сохранить длинную таблицу
+    :param cube_path: готовый куб тарифов из prepare_tariffs; если не задан, куб строится по tariffs_path
+    :param scenarios: список сценариев (base_year, min_value, weighting); если задан, в output_path
+        пишется агрегированный инструмент всех сценариев с колонкой scenario
+    :param sample_fraction: доля фирм для быстрого прогона (выборка по хэшу ИНН)
+    :param years: годы инструмента (по умолчанию все годы куба тарифов: prepare_tariffs
+        строит его по годам сырых деклараций)
+    :param weights_path: веса базового года (по умолчанию рядом с output_path);
+        сохраняются при полном прогоне и используются при обновлении
+    :param update_years: пересчитать инструмент только для этих лет по сохраненным весам
+        и заменить их строки в существующем output_path
+    """
+    if engine not in ("long", "sparse"):
+        raise ValueError("Unknown engine: {engine}".format(engine=engine))
+    years = parse_years(years)
+    update_years = parse_years(update_years)
+    if update_years is not None and scenarios is not None:
+        raise ValueError("Update mode is not supported for scenarios")
+    if weights_path is None:
+        weights_path = "{path}_weights.parquet".format(path=os.path.splitext(output_path)[0])
 
-    weights = prepare_weights(spark_path=spark_path, customs_path=customs_path, tariffs_df=tariffs)
-    df = prepare_instrument_table(weights, tariffs)
+    if cube_path is not None:
+        cube = load_tariff_cube(cube_path)
+    else:
+        cube = build_tariff_cube(apply_schema(pd.read_parquet(tariffs_path), name="tariffs"))
+    # Годы куба следуют за сырыми декларациями: при обновлении в них уже есть новые годы,
+    # так что тарифы протягиваются и лаги считаются по всем прежним годам
+    if years is None:
+        years = cube.years.tolist()
+    # Без тарифов года ffill молча скопировал бы тарифы прошлого года
+    missing = sorted((set(years) | set(update_years or [])) - set(cube.years.tolist()))
+    if missing:
+        raise ValueError("No tariffs for years {missing}: rerun prepare_tariffs with these years".format(missing=missing))
+    if update_years is not None and not set(update_years) <= set(years):
+        raise ValueError("Update years {missing} are not among instrument years {years}".format(
+            missing=sorted(set(update_years) - set(years)), years=years
+        ))
 
-    result = []
-    for _, item_df in tqdm(df.groupby(["okved_four", "product", "code"])):
-        item_df = item_df.sort_values(by=["year"])\
-                .assign(prev_tariff=lambda x: x.tariff.shift(1))
-        result.append(item_df)
+    if scenarios is not None:
+        scenarios = parse_scenarios(scenarios)
+        merged = merge_customs_spark(
+            spark_path,
+            customs_path,
+            base_years=sorted({scenario.base_year for scenario in scenarios}),
+            sample_fraction=sample_fraction
+        )
+        result = apply_schema(compute_scenarios(merged, cube, scenarios, years), name="scenarios")
+        result.to_parquet(output_path, index=False)
+        return
+
+    if update_years is None:
+        weights = prepare_weights(spark_path=spark_path, customs_path=customs_path, cube=cube, sample_fraction=sample_fraction)
+        weights.to_parquet(weights_path, index=False)
+    else:
+        # Веса считаются по базовому году и от новых лет не зависят
+        weights = pd.read_parquet(weights_path)
+
+    if engine == "sparse":
+        iv = compute_instrument_sparse(weights, cube, years, output_years=update_years)
+        if update_years is not None:
+            iv = apply_schema(replace_years(output_path, iv, update_years))\
+                    .sort_values(by=["okved_four", "year"], kind="stable", ignore_index=True)
+        iv = apply_schema(iv, name="instrument")
+        iv.to_parquet(output_path, index=False)
+        if long_output_path is None:
+            return
+        output_path = long_output_path
 
-    result = pd.concat(result).assign(tariff_diff=lambda x: x.tariff - x.prev_tariff)
+    # Лаг тарифа меняется у обновляемых лет и у следующих за ними
+    changed_years = None
+    lag_years = None
+    if update_years is not None:
+        changed_years = sorted({year + shift for year in update_years for shift in (0, 1)} & set(years))
+        lag_years = sorted({year + shift for year in update_years for shift in (-1, 0, 1)} & set(years))
+
+    df = prepare_instrument_table(weights, cube, years, output_years=lag_years)
+
+    result = panel_lag(
+        df,
+        keys=["okved_four", "product", "code"],
+        time="year",
+        lags={"prev_tariff": "tariff"},
+        diffs={"tariff_diff": "tariff"}
+    )
+    if changed_years is not None:
+        result = apply_schema(replace_years(output_path, result.loc[result["year"].isin(changed_years)], changed_years))\
+                    .sort_values(by=["okved_four", "product", "code", "year"], kind="stable", ignore_index=True)
+    result = apply_schema(result, name="instrument")
     result.to_parquet(output_path, index=False)
 
 
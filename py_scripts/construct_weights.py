@@ -1,34 +1,49 @@
 import fire
 import pandas as pd
 
+from typing import Optional
+
+try:
+    from py_scripts.process_raw_customs import read_gtd
+    from py_scripts.sampling import read_parquet_sample
+    from py_scripts.schema import apply_schema
+except ImportError:
+    from process_raw_customs import read_gtd
+    from sampling import read_parquet_sample
+    from schema import apply_schema
+
 SPARK_COLS = ["INN", "okved_four", "year"]
+CUSTOMS_COLS = ["INN", "year", "code", "product", "value"]
 
 
-def construct_weights(spark_path: str, customs_path: str):
-    spark_df = pd.read_parquet(spark_path)\
+def construct_weights(spark_path: str, customs_path: str, sample_fraction: Optional[float] = None):
+    spark_df = apply_schema(read_parquet_sample(spark_path, sample_fraction=sample_fraction), name="spark")\
                 .rename(columns={"Year": "year"})
-    customs_df = pd.read_parquet(customs_path)
+    customs_df = apply_schema(
+        read_gtd(customs_path, years=[2005], columns=CUSTOMS_COLS, sample_fraction=sample_fraction),
+        name="customs"
+    )
 
     # Filtering
     spark_df = spark_df\
-            .loc[(spark_df["year"] == 2005) & (~spark_df["okved_four"].isin(['nan', 'None'])), SPARK_COLS]
+            .loc[(spark_df["year"] == 2005) & spark_df["okved_four"].notnull() & (~spark_df["okved_four"].isin(['nan', 'None'])), SPARK_COLS]
     customs_df = customs_df.loc[(~customs_df["product"].isnull())]
     print(len(spark_df), len(customs_df))
 
     # Form the dataset
     df = pd.merge(customs_df, spark_df, on=["INN", "year"], how="inner")
     df = df.loc[df.value > 1000.]
-    df = df.groupby(["okved_four", "product", "code"]).agg({"value": "sum"}).reset_index()
+    df = df.groupby(["okved_four", "product", "code"], observed=True).agg({"value": "sum"}).reset_index()
 
     # Aggregate weights by okved
-    agg_df = df.groupby(["okved_four"]).agg({"value": "sum"})\
+    agg_df = df.groupby(["okved_four"], observed=True).agg({"value": "sum"})\
                 .reset_index().rename(columns={"value": "value_agg"})
     df = df.merge(agg_df, on=["okved_four"], how="inner")\
             .assign(weight=lambda x: x.value / x.value_agg)\
             .drop(columns=["value_agg"])
 
     # Aggregate weights by okved and country code
-    agg_df = df.groupby(["okved_four", "code"]).agg({"value": "sum"})\
+    agg_df = df.groupby(["okved_four", "code"], observed=True).agg({"value": "sum"})\
                 .reset_index().rename(columns={"value": "value_agg"})
     df = df.merge(agg_df, on=["okved_four", "code"], how="inner")\
             .assign(weight_c=lambda x: x.value / x.value_agg)\
@@ -37,8 +52,9 @@ def construct_weights(spark_path: str, customs_path: str):
     return df
 
 
-def main(spark_path: str, customs_path: str, output_path: str):
-    df = construct_weights(spark_path, customs_path)
+def main(spark_path: str, customs_path: str, output_path: str, sample_fraction: Optional[float] = None):
+    df = construct_weights(spark_path, customs_path, sample_fraction)
+    df = apply_schema(df, name="weights")
     df.to_parquet(output_path, index=False)
 
 
@@ -0,0 +1,49 @@
+import os
+import pandas as pd
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from typing import Dict, List, Optional
+
+try:
+    from py_scripts.schema import apply_schema
+except ImportError:
+    from schema import apply_schema
+
+
+def final_data_paths(output_path: str) -> Dict[str, str]:
+    """
+    Пути бинарных копий итоговой таблицы рядом с CSV
+    """
+    stem = os.path.splitext(output_path)[0]
+    return {
+        "parquet": "{stem}.parquet".format(stem=stem),
+        "arrow": "{stem}.arrow".format(stem=stem)
+    }
+
+
+def write_final_data(data: pd.DataFrame, output_path: str):
+    """
+    Сохраняет итоговую панель в parquet и в arrow IPC (feather v2) с компактными
+    типами, отсортированную по firm_id и году
+    """
+    data = apply_schema(data).sort_values(by=["firm_id", "year"], ignore_index=True)
+    paths = final_data_paths(output_path)
+    data.to_parquet(paths["parquet"], index=False)
+    # Файл без сжатия можно отобразить в память без копирования
+    feather.write_feather(data, paths["arrow"], compression="uncompressed")
+
+
+def load_final_data(path: str, columns: Optional[List[str]] = None, as_arrow: bool = False):
+    """
+    Загружает итоговую панель из .arrow или .parquet с исходными типами.
+    Файл .arrow отображается в память: буферы колонок читаются с диска
+    по мере обращения, числовые колонки без пропусков не копируются
+    :param path: путь к .arrow или .parquet
+    :param columns: колонки для загрузки (по умолчанию все)
+    :param as_arrow: вернуть pyarrow.Table без перевода в pandas
+    """
+    if path.endswith(".parquet"):
+        table = pq.read_table(path, columns=columns, memory_map=True)
+    else:
+        table = feather.read_table(path, columns=columns, memory_map=True)
+    return table if as_arrow else table.to_pandas(split_blocks=True)
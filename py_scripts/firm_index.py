@@ -0,0 +1,146 @@
+import os
+import fire
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from typing import List, Optional
+
+try:
+    from py_scripts.incremental import parse_years
+except ImportError:
+    from incremental import parse_years
+
+FIRM_KEYS = ["firm_id", "year"]
+# Множитель firm_id в общем ключе (firm_id, year)
+YEAR_BASE = 10000
+
+
+def read_inns(path: str, years: Optional[List[int]] = None) -> np.ndarray:
+    """
+    Уникальные ИНН из parquet-файла или hive-датасета: читается только колонка ИНН
+    (и строки лет years, если они заданы)
+    """
+    dataset = ds.dataset(path, format="parquet", partitioning="hive")
+    column = [item for item in dataset.schema.names if item.lower() == "inn"][0]
+    row_filter = None
+    if years is not None:
+        row_filter = ds.field([item for item in dataset.schema.names if item.lower() == "year"][0]).isin(years)
+    inns = pc.unique(dataset.to_table(columns=[column], filter=row_filter)[column]).drop_null()
+    return inns.to_numpy().astype(np.int64)
+
+
+def build_firm_index(inns: np.ndarray, existing: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    Словарь ИНН -> плотный firm_id (int32). Новые ИНН получают номера
+    по возрастанию ИНН после уже выданных, так что firm_id существующих
+    фирм не меняются, а при первой сборке порядок firm_id совпадает с порядком ИНН
+    :param inns: ИНН из всех источников
+    :param existing: ранее сохраненный индекс
+    :return: таблица inn, firm_id, отсортированная по inn
+    """
+    inns = np.unique(np.asarray(inns, dtype=np.int64))
+    if existing is None:
+        existing = pd.DataFrame({"inn": np.array([], dtype=np.int64), "firm_id": np.array([], dtype=np.int32)})
+
+    new_inns = np.setdiff1d(inns, existing["inn"].to_numpy(), assume_unique=True)
+    start = int(existing["firm_id"].max()) + 1 if len(existing) > 0 else 0
+    new = pd.DataFrame({"inn": new_inns, "firm_id": np.arange(start, start + len(new_inns), dtype=np.int32)})
+    print("Firm index: {old} firms, {new} new".format(old=len(existing), new=len(new)))
+
+    return pd.concat([existing, new], ignore_index=True)\
+            .astype({"inn": "int64", "firm_id": "int32"})\
+            .sort_values(by="inn", ignore_index=True)
+
+
+def firm_index_from_sources(
+        paths: List[str],
+        existing: Optional[pd.DataFrame] = None,
+        years: Optional[List[int]] = None
+) -> pd.DataFrame:
+    """
+    Индекс по ИНН всех источников (parquet-файлов или hive-датасетов)
+    """
+    return build_firm_index(np.concatenate([read_inns(path, years) for path in paths]), existing)
+
+
+def load_firm_index(index_path: str) -> pd.DataFrame:
+    return pd.read_parquet(index_path).sort_values(by="inn", ignore_index=True)
+
+
+def inn_to_firm_id(index: pd.DataFrame, inns) -> np.ndarray:
+    """
+    Переводит ИНН в firm_id бинарным поиском по отсортированному индексу
+    """
+    inns = np.asarray(inns, dtype=np.int64)
+    index_inns = index["inn"].to_numpy()
+    pos = np.searchsorted(index_inns, inns).clip(0, max(len(index_inns) - 1, 0))
+    missing = (index_inns[pos] != inns) if len(index_inns) > 0 else np.ones(len(inns), dtype=bool)
+    if missing.any():
+        raise ValueError("{count} INNs are missing from the firm index".format(count=int(missing.sum())))
+    return index["firm_id"].to_numpy()[pos]
+
+
+def add_firm_id(df: pd.DataFrame, index: pd.DataFrame, sort_by: List[str] = ["firm_id", "year"]) -> pd.DataFrame:
+    """
+    Добавляет колонку firm_id и сортирует таблицу по firm_id и году
+    (если таблица уже в этом порядке, сортировка пропускается)
+    """
+    df = df.assign(firm_id=inn_to_firm_id(index, df["inn"]))
+    if sort_by == FIRM_KEYS and pd.Index(firm_year_key(df)).is_monotonic_increasing:
+        return df.reset_index(drop=True)
+    return df.sort_values(by=sort_by, kind="stable", ignore_index=True)
+
+
+def firm_year_key(df: pd.DataFrame) -> np.ndarray:
+    """
+    Ключ (firm_id, year) одним int64: порядок ключей совпадает с сортировкой по (firm_id, year)
+    """
+    return df["firm_id"].to_numpy(dtype=np.int64) * YEAR_BASE + df["year"].to_numpy(dtype=np.int64)
+
+
+def sorted_merge(left: pd.DataFrame, right: pd.DataFrame, how: str = "inner") -> pd.DataFrame:
+    """
+    Соединение двух таблиц, отсортированных по (firm_id, year), слиянием
+    отсортированных массивов ключей вместо hash merge: для монотонных индексов
+    pandas соединяет их одним проходом (libjoin). Строки результата
+    отсортированы по (firm_id, year), как у merge(on=["firm_id", "year"])
+    :param how: inner, left или outer
+    """
+    keyed = []
+    for df in [left, right]:
+        key = pd.Index(firm_year_key(df), name="firm_year")
+        if not key.is_monotonic_increasing:
+            raise ValueError("Tables must be sorted by (firm_id, year) for a sorted merge")
+        keyed.append(df.drop(columns=FIRM_KEYS).set_axis(key, axis=0))
+
+    # Суффиксы совпадающих колонок - как у merge
+    result = keyed[0].join(keyed[1], how=how, lsuffix="_x", rsuffix="_y")
+    key = result.index.to_numpy()
+    result = result.reset_index(drop=True)
+    # Колонки ключа возвращаются на свои места в left
+    for col in sorted(FIRM_KEYS, key=left.columns.get_loc):
+        values = key // YEAR_BASE if col == "firm_id" else key % YEAR_BASE
+        result.insert(left.columns.get_loc(col), col, values.astype(left[col].dtype))
+    return result
+
+
+def main(
+        spark_path: str,
+        ruslana_path: str,
+        gtd_path: str,
+        output_path: str,
+        years: Optional[List[int]] = None
+):
+    """
+    Собирает общий индекс фирм по ИНН из Spark, Ruslana и GTD.
+    Если индекс уже есть, дописывает в него только новые ИНН
+    :param years: читать ИНН только этих лет (при добавлении нового года)
+    """
+    existing = load_firm_index(output_path) if os.path.exists(output_path) else None
+    firm_index_from_sources([spark_path, ruslana_path, gtd_path], existing, parse_years(years))\
+        .to_parquet(output_path, index=False)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,40 @@
+import os
+import pandas as pd
+import pyarrow.dataset as ds
+from typing import List, Optional
+
+
+def parse_years(years) -> Optional[List[int]]:
+    """
+    Список лет из аргумента командной строки: fire передает один год числом,
+    несколько - списком, кортежем или строкой через запятую
+    """
+    if years is None:
+        return None
+    if isinstance(years, str):
+        years = years.split(",")
+    elif isinstance(years, int):
+        years = [years]
+    return sorted({int(year) for year in years})
+
+
+def year_column(names) -> str:
+    return [item for item in names if str(item).lower() == "year"][0]
+
+
+def replace_years(path: str, new: pd.DataFrame, years: List[int]) -> pd.DataFrame:
+    """
+    Существующая таблица path, в которой строки лет years заменены строками new.
+    С диска читаются только строки остальных лет; если таблицы еще нет, возвращается new
+    :param path: parquet-файл или папка с parquet-файлами
+    :param new: строки обновляемых лет
+    :param years: обновляемые годы
+    """
+    if not os.path.exists(path):
+        return new
+    dataset = ds.dataset(path, format="parquet")
+    old = dataset.to_table(filter=~ds.field(year_column(dataset.schema.names)).isin(years)).to_pandas()
+    print("Replacing years {years}: {old} rows kept, {new} rows added".format(
+        years=", ".join(map(str, years)), old=len(old), new=len(new)
+    ))
+    return pd.concat([old, new], ignore_index=True)
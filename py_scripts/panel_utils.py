@@ -0,0 +1,36 @@
+import pandas as pd
+from typing import Dict, List, Optional
+
+
+def panel_lag(
+        df: pd.DataFrame,
+        *,
+        keys: List[str],
+        time: str,
+        lags: Optional[Dict[str, str]] = None,
+        diffs: Optional[Dict[str, str]] = None,
+        periods: int = 1
+) -> pd.DataFrame:
+    """
+    Считает лаги и разности колонок панели за один проход: таблица один раз
+    сортируется по ключам и времени, затем делается сгруппированный shift.
+    Как и shift внутри группы, лаг берется по предыдущей строке панели,
+    а не по предыдущему календарному году.
+    :param df: таблица панели
+    :param keys: колонки, задающие единицу панели
+    :param time: колонка времени
+    :param lags: {имя новой колонки: колонка} для лагов
+    :param diffs: {имя новой колонки: колонка} для разностей col - lag(col)
+    :param periods: величина лага
+    :return: таблица, отсортированная по keys + [time], с новыми колонками
+    """
+    lags = lags or {}
+    diffs = diffs or {}
+
+    df = df.sort_values(by=keys + [time], kind="stable")
+    source_cols = list(dict.fromkeys(list(lags.values()) + list(diffs.values())))
+    shifted = df.groupby(keys, sort=False)[source_cols].shift(periods)
+
+    new_cols = {name: shifted[col] for name, col in lags.items()}
+    new_cols.update({name: df[col] - shifted[col] for name, col in diffs.items()})
+    return df.assign(**new_cols)
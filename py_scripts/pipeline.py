@@ -0,0 +1,367 @@
+import os
+import sys
+import json
+import hashlib
+import subprocess
+import fire
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, List, NamedTuple, Optional
+
+try:
+    from py_scripts.process_raw_customs import raw_gtd_years
+except ImportError:
+    from process_raw_customs import raw_gtd_years
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = ".pipeline_state.json"
+# Параметры режима обновления не входят в отпечаток стадии: годы полной сборки
+# берутся из данных, поэтому результат обновления совпадает с полной пересборкой,
+# и следующий обычный запуск ее не повторяет
+UPDATE_PARAMS = ["update_years", "years"]
+
+
+class Stage(NamedTuple):
+    name: str
+    script: str
+    inputs: List[str]
+    outputs: List[str]
+    params: Dict[str, object]
+    # Вспомогательные модули, изменение которых тоже требует перезапуска
+    modules: List[str] = []
+
+
+def sample_dir(sample_fraction: float) -> str:
+    return "sample_{fraction}".format(fraction=sample_fraction)
+
+
+def state_key(stage: Stage) -> str:
+    """
+    Ключ стадии в файле состояния: прогоны с выборкой хранятся отдельно от полного,
+    чтобы полный запуск после быстрого не перезапускал стадии
+    """
+    sample_fraction = stage.params.get("sample_fraction")
+    if sample_fraction is None:
+        return stage.name
+    return "{name}@{sample}".format(name=stage.name, sample=sample_dir(sample_fraction))
+
+
+def make_stages(
+        data_dir: str,
+        sample_fraction: Optional[float] = None,
+        update_years: Optional[List[int]] = None
+) -> List[Stage]:
+    """
+    Описание стадий пайплайна: те же скрипты и аргументы, что в Makefile.
+    Выборка фирм передается только стадиям после обработки сырых данных;
+    их выходы пишутся в отдельную папку выборки и не затирают полный прогон.
+    При update_years стадии обрабатывают только эти годы и обновляют свои выходы
+    """
+    path = lambda *parts: os.path.join(data_dir, *parts)
+    sampling = dict(sample_fraction=sample_fraction) if sample_fraction is not None else {}
+    # Выходы стадий с выборкой: data_dir/sample_<доля>/... вместо data_dir/...
+    sampled_path = path if sample_fraction is None else \
+            lambda *parts: path(sample_dir(sample_fraction), *parts)
+    update = dict(update_years=update_years) if update_years is not None else {}
+    years = dict(years=update_years) if update_years is not None else {}
+    # Тарифы нужны на все годы сырых деклараций: список лет входит в отпечаток стадии,
+    # так что новый год деклараций пересобирает тарифы и все, что от них зависит
+    raw_gtd = path("gtd", "gtd2005-2009")
+    tariff_years = dict(years_of_interest=raw_gtd_years(raw_gtd)) if os.path.isdir(raw_gtd) else {}
+
+    return [
+        Stage(
+            name="process_raw_spark",
+            script="process_raw_spark.py",
+            inputs=[path("spark", "raw_data")],
+            outputs=[path("spark", "cur_spark_data_v3.parquet")],
+            params=dict(
+                data_dir=path("spark", "raw_data"),
+                output_path=path("spark", "cur_spark_data_v3.parquet"),
+                source="CUR",
+                **update
+            ),
+            modules=["incremental.py"]
+        ),
+        Stage(
+            name="process_raw_customs",
+            script="process_raw_customs.py",
+            inputs=[raw_gtd, path("countries", "rus_countries.csv")],
+            outputs=[path("gtd", "gtd_processed")],
+            params=dict(
+                data_path=raw_gtd,
+                output_path=path("gtd", "gtd_processed"),
+                partitioned=True,
+                countries_path=path("countries", "rus_countries.csv"),
+                **years
+            ),
+            modules=["incremental.py"]
+        ),
+        Stage(
+            name="prepare_tariffs",
+            script="prepare_tariffs.py",
+            inputs=[path("tariffs", "MFN")],
+            outputs=[path("instrument", "tariffs.parquet"), path("instrument", "tariff_cube")],
+            params=dict(
+                folder=path("tariffs", "MFN"),
+                target_path=path("instrument", "tariffs.parquet"),
+                streaming=True,
+                cube_path=path("instrument", "tariff_cube"),
+                gtd_path=raw_gtd,
+                **tariff_years
+            ),
+            modules=["tariff_cube.py", "process_raw_customs.py"]
+        ),
+        Stage(
+            name="construct_instrument",
+            script="construct_instrument_v2.py",
+            inputs=[
+                path("spark", "cur_spark_data_v3.parquet"),
+                # Веса зависят только от базового года; новые годы деклараций
+                # меняют годы инструмента через тарифы и куб
+                path("gtd", "gtd_processed", "year=2005"),
+                path("instrument", "tariffs.parquet"),
+                path("instrument", "tariff_cube")
+            ],
+            outputs=[sampled_path("instrument", "iv.parquet"), sampled_path("instrument", "iv_weights.parquet")],
+            params=dict(
+                spark_path=path("spark", "cur_spark_data_v3.parquet"),
+                customs_path=path("gtd", "gtd_processed"),
+                tariffs_path=path("instrument", "tariffs.parquet"),
+                output_path=sampled_path("instrument", "iv.parquet"),
+                cube_path=path("instrument", "tariff_cube"),
+                weights_path=sampled_path("instrument", "iv_weights.parquet"),
+                **sampling,
+                **update
+            ),
+            modules=["panel_utils.py", "process_raw_customs.py", "tariff_cube.py", "sampling.py", "incremental.py"]
+        ),
+        Stage(
+            name="build_firm_index",
+            script="firm_index.py",
+            inputs=[
+                path("spark", "cur_spark_data_v3.parquet"),
+                path("ruslana", "ruslana.parquet"),
+                path("gtd", "gtd_processed")
+            ],
+            outputs=[path("firm_index.parquet")],
+            params=dict(
+                spark_path=path("spark", "cur_spark_data_v3.parquet"),
+                ruslana_path=path("ruslana", "ruslana.parquet"),
+                gtd_path=path("gtd", "gtd_processed"),
+                output_path=path("firm_index.parquet"),
+                **years
+            ),
+            modules=["incremental.py"]
+        ),
+        Stage(
+            name="prepare_data_simple",
+            script="prepare_data_simple_v1.py",
+            inputs=[
+                path("spark", "cur_spark_data_v3.parquet"),
+                path("ruslana", "ruslana.parquet"),
+                path("gtd", "gtd_processed"),
+                sampled_path("instrument", "iv.parquet"),
+                path("firm_index.parquet")
+            ],
+            outputs=[
+                sampled_path("testing", "cur_final_data_simple_v3.csv"),
+                sampled_path("testing", "cur_final_data_simple_v3.parquet"),
+                sampled_path("testing", "cur_final_data_simple_v3.arrow"),
+                sampled_path("testing", "cur_final_data_simple_v3_cutoffs.json"),
+                sampled_path("testing", "cur_final_data_simple_v3_merged")
+            ],
+            params=dict(
+                spark_path=path("spark", "cur_spark_data_v3.parquet"),
+                ruslana_path=path("ruslana", "ruslana.parquet"),
+                gtd_path=path("gtd", "gtd_processed"),
+                iv_path=sampled_path("instrument", "iv.parquet"),
+                output_path=sampled_path("testing", "cur_final_data_simple_v3.csv"),
+                firm_index_path=path("firm_index.parquet"),
+                merged_path=sampled_path("testing", "cur_final_data_simple_v3_merged"),
+                **sampling,
+                **update
+            ),
+            modules=[
+                "panel_utils.py",
+                "process_raw_customs.py",
+                "firm_index.py",
+                "sampling.py",
+                "winsorize.py",
+                "final_data.py",
+                "incremental.py"
+            ]
+        ),
+    ]
+
+
+def file_hash(file_path: str, cache: Dict[str, list]) -> str:
+    """
+    Хэш содержимого файла. Хэш пересчитывается, только если
+    изменились размер или время изменения файла
+    """
+    stat = os.stat(file_path)
+    cached = cache.get(file_path)
+    if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+        return cached[2]
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    cache[file_path] = [stat.st_size, stat.st_mtime, digest.hexdigest()]
+    return cache[file_path][2]
+
+
+def path_hash(path: str, cache: Dict[str, list]) -> Optional[str]:
+    """
+    Хэш файла или папки (по относительным путям и содержимому всех файлов)
+    """
+    if os.path.isfile(path):
+        return file_hash(path, cache)
+    if not os.path.isdir(path):
+        return None
+
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file_name in sorted(files):
+            if file_name.startswith("."):
+                continue
+            file_path = os.path.join(root, file_name)
+            digest.update(os.path.relpath(file_path, path).encode())
+            digest.update(file_hash(file_path, cache).encode())
+    return digest.hexdigest()
+
+
+def stage_fingerprint(stage: Stage, cache: Dict[str, list]) -> str:
+    code = [os.path.join(SCRIPTS_DIR, item) for item in [stage.script] + stage.modules]
+    payload = dict(
+        params={key: str(val) for key, val in stage.params.items() if key not in UPDATE_PARAMS},
+        inputs={item: path_hash(item, cache) for item in stage.inputs},
+        code={os.path.basename(item): path_hash(item, cache) for item in code}
+    )
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def stage_dependencies(stages: List[Stage]) -> Dict[str, set]:
+    """
+    Стадия зависит от другой, если хотя бы один ее вход лежит внутри выхода другой
+    """
+    produces = lambda output, item: item == output or item.startswith(output.rstrip(os.sep) + os.sep)
+    return {
+        stage.name: {
+            other.name for other in stages
+            if other is not stage and any(produces(output, item) for output in other.outputs for item in stage.inputs)
+        }
+        for stage in stages
+    }
+
+
+def run_stage(stage: Stage):
+    for output in stage.outputs:
+        # Выходы без расширения - папки, в которые скрипт пишет файлы
+        target_dir = output if not os.path.splitext(output)[1] else os.path.dirname(output)
+        os.makedirs(target_dir, exist_ok=True)
+
+    cmd = [sys.executable, os.path.join(SCRIPTS_DIR, stage.script)]
+    for key, val in stage.params.items():
+        if isinstance(val, bool):
+            cmd += ["--{key}".format(key=key)] if val else ["--no{key}".format(key=key)]
+        else:
+            cmd += ["--{key}".format(key=key), str(val)]
+    print("[{name}] {cmd}".format(name=stage.name, cmd=" ".join(cmd)))
+    subprocess.run(cmd, check=True)
+
+
+def load_state(state_path: str) -> dict:
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            return json.load(f)
+    return dict(files={}, stages={})
+
+
+def save_state(state: dict, state_path: str):
+    with open(state_path, "w") as f:
+        json.dump(state, f, indent=2)
+
+
+def main(
+        data_dir: str = "data",
+        stages: Optional[List[str]] = None,
+        force: bool = False,
+        workers: int = 3,
+        dry_run: bool = False,
+        sample_fraction: Optional[float] = None,
+        update_years: Optional[List[int]] = None
+):
+    """
+    Запускает стадии пайплайна, пропуская те, у которых не изменились
+    входы, параметры и код. Независимые стадии идут параллельно
+    :param data_dir: папка с данными
+    :param stages: список стадий для запуска (по умолчанию все)
+    :param force: перезапустить выбранные стадии без проверки хэшей
+    :param workers: число одновременно запущенных стадий
+    :param dry_run: только показать, какие стадии будут запущены
+    :param sample_fraction: доля фирм для быстрого прогона; выходы стадий с выборкой
+        пишутся в data_dir/sample_<доля> и не затирают результаты полного прогона
+    :param update_years: добавить или обновить только эти годы поверх выходов прошлого запуска
+    """
+    all_stages = make_stages(data_dir, sample_fraction=sample_fraction, update_years=update_years)
+    if stages is not None:
+        stages = [stages] if isinstance(stages, str) else list(stages)
+        unknown = set(stages) - {stage.name for stage in all_stages}
+        if unknown:
+            raise ValueError("Unknown stages: {unknown}".format(unknown=", ".join(sorted(unknown))))
+        all_stages = [stage for stage in all_stages if stage.name in stages]
+
+    dependencies = stage_dependencies(all_stages)
+    state_path = os.path.join(data_dir, STATE_FILE)
+    state = load_state(state_path)
+
+    pending = list(all_stages)
+    running = {}
+    done = set()
+    failed = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while (pending and failed is None) or running:
+            ready = [stage for stage in pending if dependencies[stage.name] <= done] if failed is None else []
+            for stage in ready:
+                pending.remove(stage)
+                fingerprint = stage_fingerprint(stage, state["files"])
+                is_fresh = state["stages"].get(state_key(stage)) == fingerprint\
+                        and all(os.path.exists(output) for output in stage.outputs)
+                if is_fresh and not force:
+                    print("[{name}] up to date, skipping".format(name=stage.name))
+                    done.add(stage.name)
+                elif dry_run:
+                    print("[{name}] would run".format(name=stage.name))
+                    done.add(stage.name)
+                else:
+                    running[executor.submit(run_stage, stage)] = (stage, fingerprint)
+
+            if not running:
+                if not ready:
+                    break
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, fingerprint = running.pop(future)
+                try:
+                    future.result()
+                except subprocess.CalledProcessError as e:
+                    print("[{name}] failed: {error}".format(name=stage.name, error=e))
+                    failed = stage.name
+                    continue
+                state["stages"][state_key(stage)] = fingerprint
+                save_state(state, state_path)
+                done.add(stage.name)
+
+    save_state(state, state_path)
+    if failed is not None:
+        raise RuntimeError("Stage {name} failed".format(name=failed))
+    print("Pipeline finished")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
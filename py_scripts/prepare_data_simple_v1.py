@@ -1,8 +1,31 @@
 import os
+import glob
 import fire
 import numpy as np
 import pandas as pd
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from py_scripts.final_data import write_final_data
+    from py_scripts.firm_index import add_firm_id, firm_index_from_sources, load_firm_index, sorted_merge
+    from py_scripts.incremental import parse_years
+    from py_scripts.panel_utils import panel_lag
+    from py_scripts.process_raw_customs import gtd_years, read_gtd
+    from py_scripts.sampling import read_parquet_sample, sample_firms
+    from py_scripts.schema import apply_schema
+    from py_scripts.winsorize import load_cutoffs, make_sketches, merge_sketches, save_cutoffs, sketch_cutoffs, update_sketches
+except ImportError:
+    from final_data import write_final_data
+    from firm_index import add_firm_id, firm_index_from_sources, load_firm_index, sorted_merge
+    from incremental import parse_years
+    from panel_utils import panel_lag
+    from process_raw_customs import gtd_years, read_gtd
+    from sampling import read_parquet_sample, sample_firms
+    from schema import apply_schema
+    from winsorize import load_cutoffs, make_sketches, merge_sketches, save_cutoffs, sketch_cutoffs, update_sketches
 
 FINAL_COLS = [
     "year",
@@ -27,94 +50,181 @@ FINAL_COLS = [
 ]
 
 
-def return_unique(x):
-    return len(x.unique())
+GTD_COLS = ["inn", "year", "code", "product", "value"]
+
+# Панель экспортеров начинается с года до первых деклараций
+EXPORT_FIRST_YEAR = 2004
+# countries_diff_prev - лаг разности, поэтому год t влияет на признаки лет t + 1 и t + 2
+EXPORT_LAG_DEPTH = 2
+# Колонки, которые добавляет add_export_features
+EXPORT_FEATURE_COLS = [
+    "num_countries_prev",
+    "countries_diff",
+    "countries_diff_prev",
+    "num_deliveries_prev",
+    "value_prev",
+    "num_countries_prev_log",
+    "num_deliveries_prev_log",
+    "value_prev_log",
+    "expansion",
+    "exporting"
+]
 
 
-def prepare_gtd_df(gtd_path: str):
+def aggregate_gtd_year(
+        gtd_path: str,
+        year: int,
+        sample_fraction: Optional[float] = None,
+        shard: Optional[Tuple[int, int]] = None
+) -> pd.DataFrame:
+    """
+    Читает из датасета GTD только партицию года и нужные колонки
+    и агрегирует экспорт до уровня (inn, year)
+    """
     TO_RENAME = {
         "code": "num_countries",
         "product": "num_deliveries"
     }
-    gtd_tables = os.listdir(gtd_path)
-    gtd_df = []
-    for gtd_file in tqdm(gtd_tables):
-        df = pd.read_parquet(os.path.join(gtd_path, gtd_file))
-        df.columns = [item.lower() for item in df.columns]
-        try:
-            df = df.assign(value=lambda x: x.value.str.replace(',', '.').astype(float))
-        except AttributeError:
-            df = df.assign(value=lambda x: x.value.astype(float))
-        df = df.loc[(df["inn"] > 100) & (~df["product"].isnull())]\
-                .groupby(["inn", "year"]).agg({"code": return_unique, "product": "count", "value": "sum"})\
-                .reset_index().rename(columns=TO_RENAME)
-        gtd_df.append(df)
-    gtd_df = pd.concat(gtd_df)
+    df = read_gtd(gtd_path, years=[year], columns=GTD_COLS, sample_fraction=sample_fraction, shard=shard)
+    df.columns = [item.lower() for item in df.columns]
+    try:
+        df = df.assign(value=lambda x: x.value.str.replace(',', '.').astype(float))
+    except AttributeError:
+        df = df.assign(value=lambda x: x.value.astype(float))
+    return df.loc[(df["inn"] > 100) & (~df["product"].isnull())]\
+            .groupby(["inn", "year"]).agg({"code": "nunique", "product": "count", "value": "sum"})\
+            .reset_index().rename(columns=TO_RENAME)
+
+
+def prepare_gtd_df(
+        gtd_path: str,
+        workers: int = 1,
+        sample_fraction: Optional[float] = None,
+        shard: Optional[Tuple[int, int]] = None,
+        years: Optional[List[int]] = None
+):
+    """
+    :param years: годы для чтения (по умолчанию все партиции)
+    """
+    years = [year for year in gtd_years(gtd_path) if years is None or year in years]
+    aggregate = partial(aggregate_gtd_year, gtd_path, sample_fraction=sample_fraction, shard=shard)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            gtd_df = list(tqdm(executor.map(aggregate, years), total=len(years)))
+    else:
+        gtd_df = [aggregate(year) for year in tqdm(years, disable=shard is not None)]
+    gtd_df = apply_schema(pd.concat(gtd_df), name="gtd")
     print("Len of GTD table: {}".format(len(gtd_df)))
     return gtd_df
 
 
 def prepare_iv_df(iv_path: str):
-    iv_df = pd.read_parquet(iv_path)\
-            .assign(instrument=lambda x: x["weight"] * (x["tariff"]) / 100)\
-            .assign(instrument_c=lambda x: x["weight_c"] * (x["tariff"]) / 100)
-    
-    iv_df = iv_df.groupby(["okved_four", "year"])[["instrument", "instrument_c"]].sum().reset_index()
+    iv_df = pd.read_parquet(iv_path)
+
+    # Таблица от engine="sparse" уже агрегирована до (okved_four, year)
+    if "instrument" not in iv_df.columns:
+        iv_df = iv_df\
+                .assign(instrument=lambda x: x["weight"] * (x["tariff"]) / 100)\
+                .assign(instrument_c=lambda x: x["weight_c"] * (x["tariff"]) / 100)
+        iv_df = iv_df.groupby(["okved_four", "year"], observed=True)[["instrument", "instrument_c"]].sum().reset_index()
+    iv_df = apply_schema(iv_df, name="iv")
     print("Len of IV table: {}".format(len(iv_df)))
     return iv_df
 
 
-def join_all_tables(
+def prepare_export_panel(df: pd.DataFrame, years: np.ndarray) -> pd.DataFrame:
+    """
+    Строит сбалансированную панель экспортеров (firm_id × years) одним reindex
+    и считает лаги и приросты экспортных показателей по колонкам
+    """
+    EXPORT_COLS = ["num_countries", "num_deliveries", "value"]
+
+    exporters = df.loc[~df.num_countries.isnull(), ["firm_id", "year"] + EXPORT_COLS]
+    years = np.asarray(years, dtype=exporters["year"].dtype)
+    index = pd.MultiIndex.from_product([np.sort(exporters["firm_id"].unique()), years], names=["firm_id", "year"])
+    panel = exporters.set_index(["firm_id", "year"])\
+                .reindex(index)\
+                .fillna({col: 0.0 for col in EXPORT_COLS})\
+                .reset_index()
+
+    panel = panel_lag(
+        panel,
+        keys=["firm_id"],
+        time="year",
+        lags={
+            "num_countries_prev": "num_countries",
+            "num_deliveries_prev": "num_deliveries",
+            "value_prev": "value"
+        },
+        diffs={"countries_diff": "num_countries"}
+    )
+    panel = panel_lag(panel, keys=["firm_id"], time="year", lags={"countries_diff_prev": "countries_diff"})
+
+    return panel.loc[:,["firm_id", "year", "num_countries_prev", "countries_diff", "countries_diff_prev", "num_deliveries_prev", "value_prev"]]
+
+
+def merge_firm_tables(
         spark_df: pd.DataFrame,
         ruslana_df: pd.DataFrame,
         gtd_df: pd.DataFrame,
         iv_df: pd.DataFrame
-):
-    df = spark_df.merge(ruslana_df, on=["inn", "year"], how="inner")\
-                .merge(iv_df, on=["okved_four", "year"], how="inner")\
-                .merge(gtd_df, on=["inn", "year"], how="outer")\
-                .drop_duplicates(["inn", "year"])
-    
-    years = pd.DataFrame(np.arange(2004, 2010), columns=["year"])
-    export_data = []
-    for inn, item_df in tqdm(df.loc[~df.num_countries.isnull()].groupby("inn")):
-        item_df = item_df.merge(years, on="year", how="right")\
-                    .assign(
-                        inn=inn,
-                        num_countries=lambda x: x.num_countries.fillna(0.0), 
-                        num_countries_prev=lambda x: x.num_countries.shift(1),
-                        countries_diff=lambda x: x.num_countries - x.num_countries_prev,
-                        countries_diff_prev=lambda x: x.countries_diff.shift(1),
-                        num_deliveries=lambda x: x.num_deliveries.fillna(0.0),
-                        num_deliveries_prev=lambda x: x.num_deliveries.shift(1),
-                        value=lambda x: x.value.fillna(0.0),
-                        value_prev=lambda x: x.value.shift(1),
-                    )
-
-        export_data.append(item_df)
-
-    export_data = pd.concat(export_data)\
-                    .loc[:,["inn", "year", "num_countries_prev", "countries_diff", "countries_diff_prev", "num_deliveries_prev", "value_prev"]]
-    
-    df = df.merge(export_data, on=["inn", "year"], how="left")\
+) -> pd.DataFrame:
+    # Таблицы отсортированы по (firm_id, year) и соединяются слиянием отсортированных ключей,
+    # ИНН остается только в Spark. Merge с IV по (okved_four, year) сохраняет порядок строк
+    df = sorted_merge(spark_df, ruslana_df.drop(columns="inn"), how="inner")\
+                .merge(iv_df, on=["okved_four", "year"], how="inner")
+    return sorted_merge(df, gtd_df.drop(columns="inn"), how="outer")\
+                .drop_duplicates(["firm_id", "year"])
+
+
+def add_export_features(df: pd.DataFrame, export_data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Добавляет лаги из prepare_export_panel и производные экспортные признаки.
+    У фирм вне панели экспортеров лаги нулевые, как и у экспортеров в годы без поставок:
+    признаки года не зависят от того, экспортирует ли фирма в другие годы
+    """
+    return sorted_merge(df, export_data, how="left")\
             .assign(
                 num_countries=lambda x: x.num_countries.fillna(0.0),
-                num_countries_prev_log=lambda x: np.log(1 + x.num_countries_prev.fillna(0.0)),
-                num_deliveries_prev_log=lambda x: np.log(1 + x.num_deliveries_prev.fillna(0.0)),
-                value_prev_log=lambda x: np.log(1 + x.value_prev.fillna(0.0)),
+                num_countries_prev=lambda x: x.num_countries_prev.fillna(0.0),
+                num_deliveries_prev=lambda x: x.num_deliveries_prev.fillna(0.0),
+                value_prev=lambda x: x.value_prev.fillna(0.0),
+                num_countries_prev_log=lambda x: np.log(1 + x.num_countries_prev),
+                num_deliveries_prev_log=lambda x: np.log(1 + x.num_deliveries_prev),
+                value_prev_log=lambda x: np.log(1 + x.value_prev),
                 countries_diff=lambda x: x.countries_diff.fillna(0.0),
                 countries_diff_prev=lambda x: x.countries_diff_prev.fillna(0.0),
                 expansion=lambda x: 1 * (x.countries_diff > 0.0),
                 exporting=lambda x: 1 * (x.num_countries > 0.0)
             )
+
+
+def join_all_tables(
+        spark_df: pd.DataFrame,
+        ruslana_df: pd.DataFrame,
+        gtd_df: pd.DataFrame,
+        iv_df: pd.DataFrame
+):
+    df = merge_firm_tables(spark_df, ruslana_df, gtd_df, iv_df)
+
+    export_data = prepare_export_panel(df, years=np.arange(EXPORT_FIRST_YEAR, df["year"].max() + 1))
+
+    df = add_export_features(df, export_data)
     print("Len of merged table: {}".format(len(df)))
     return df
         
 
-def filter_data(df: pd.DataFrame):
-    filter_cond = (df.assets > 0.)
-    data = df.loc[filter_cond]\
-            .sort_values(by=["inn", "year"])\
+FILTER_QUANTILES = [0.01, 0.99]
+# Колонки с двусторонним и только верхним отсечением по квантилям
+TWO_SIDED_COLS = ["assets", "tangibility", "profitability"]
+UPPER_COLS = ["short_debt", "long_debt"]
+
+
+def add_ratios(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Оставляет фирмы с положительными активами и считает относительные показатели
+    """
+    return df.loc[df.assets > 0.]\
             .assign(
                 short_leverage=lambda x: x.short_debt / x.assets, 
                 long_leverage=lambda x: x.long_debt / x.assets, 
@@ -123,9 +233,25 @@ def filter_data(df: pd.DataFrame):
                 tangibility=lambda x: x.tang_assets / x.assets, 
                 profitability=lambda x: x.profit / x.assets
             )
-    print("Assets more then 0: {}".format(len(data)))
 
-    left, right = data.assets.quantile([0.01, 0.99]).tolist()
+
+def cutoff_sketches(data: pd.DataFrame, exact: bool = False) -> dict:
+    """
+    Скетчи квантилей колонок для отсечения выбросов: скетчи кусков
+    и шардов сливаются, exact=True дает точные квантили
+    """
+    return update_sketches(make_sketches(TWO_SIDED_COLS + UPPER_COLS, exact=exact), data)
+
+
+def compute_cutoffs(data: pd.DataFrame, exact: bool = True) -> Dict[str, Tuple[float, float]]:
+    """
+    Квантили 1% и 99% для отсечения выбросов (по всей выборке фирм).
+    Таблица целиком в памяти, поэтому по умолчанию квантили точные, как Series.quantile
+    """
+    return sketch_cutoffs(cutoff_sketches(data, exact=exact), FILTER_QUANTILES)
+
+
+def apply_filters(data: pd.DataFrame, cutoffs: Dict[str, Tuple[float, float]]) -> pd.DataFrame:
     filter_cond = (
         (data["short_leverage"] >= 0.) &
         (data["long_leverage"] >= 0.) &
@@ -134,71 +260,359 @@ def filter_data(df: pd.DataFrame):
         (data.empl >= 5.0)
     )
 
-    filtering_cols = [
-        "assets",
-        "tangibility",
-        "profitability"
-    ]
-    for item in filtering_cols:
-        left, right = data[item].quantile([0.01, 0.99]).tolist()
+    for item in TWO_SIDED_COLS:
+        left, right = cutoffs[item]
         filter_cond = filter_cond & (data[item] > left) & (data[item] < right)
 
-    filtering_cols = [
-        "short_debt",
-        "long_debt"
-    ]
-    for item in filtering_cols:
-        left, right = data[item].quantile([0.01, 0.99]).tolist()
+    for item in UPPER_COLS:
+        left, right = cutoffs[item]
         filter_cond = filter_cond & (data[item] < right)
 
-    data = data.loc[filter_cond]
+    return data.loc[filter_cond]
+
+
+def filter_data(
+        df: pd.DataFrame,
+        cutoffs: Optional[Dict[str, Tuple[float, float]]] = None
+) -> Tuple[pd.DataFrame, Dict[str, Tuple[float, float]]]:
+    """
+    :param cutoffs: готовые пороги (например, из файла прошлого прогона);
+        если не заданы, считаются точные квантили по всей таблице
+    :return: отфильтрованная таблица и использованные пороги
+    """
+    data = add_ratios(df).sort_values(by=["firm_id", "year"])
+    print("Assets more then 0: {}".format(len(data)))
+
+    if cutoffs is None:
+        cutoffs = compute_cutoffs(data)
+    data = apply_filters(data, cutoffs)
     print("Employees no less than 5: {}".format(len(data)))
 
     data = data.loc[data.year > 2005]
     print("Dataset length: {}".format(len(data)))
 
-    return data
+    return data, cutoffs
 
 
 def write_to_csv(df: pd.DataFrame, output_path: str):
-    data = df.dropna(subset=["inn"] + FINAL_COLS).drop_duplicates(subset=["inn", "year"])
-    inns = data["inn"].unique()
-
-    inns = pd.DataFrame(inns, columns=["inn"])\
-        .reset_index().rename(columns={"index": "firm_id"})
-
-    data = data.merge(inns, on=["inn"], how="inner")\
+    # firm_id берется из общего индекса фирм
+    data = df.dropna(subset=["firm_id"] + FINAL_COLS).drop_duplicates(subset=["firm_id", "year"])\
                 .assign(alternative_iv = lambda x: x["instrument"] * (1 + x["num_countries_prev_log"]))\
                 .assign(exp_diff = lambda x: x.exporting - x.expansion)
     print("Final dataset length: {}".format(len(data)))
-    data.loc[:,["firm_id"] + FINAL_COLS + ["alternative_iv", "exp_diff"]].to_csv(output_path, index=False)
+    data = data.loc[:,["firm_id"] + FINAL_COLS + ["alternative_iv", "exp_diff"]]
+    data.to_csv(output_path, index=False)
+    # Бинарные копии для ноутбуков: final_data.load_final_data
+    write_final_data(data, output_path)
 
 
-def main(
+def load_firm_tables(
         spark_path: str,
         ruslana_path: str,
         gtd_path: str,
-        iv_path: str,
-        output_path: str
-):
-    spark_df = pd.read_parquet(spark_path)
+        *,
+        workers: int = 1,
+        sample_fraction: Optional[float] = None,
+        shard: Optional[Tuple[int, int]] = None,
+        years: Optional[List[int]] = None,
+        customs_years: Optional[List[int]] = None
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Читает таблицы Spark, Ruslana и GTD (только фирмы выборки и шарда)
+    :param years: годы Spark и Ruslana (по умолчанию все)
+    :param customs_years: годы GTD (по умолчанию years)
+    """
+    customs_years = years if customs_years is None else customs_years
+    spark_df = read_parquet_sample(spark_path, sample_fraction=sample_fraction, shard=shard, years=years)
     spark_df.columns = [item.lower() for item in spark_df.columns]
+    spark_df = apply_schema(spark_df, name="spark")
     print("Len of Spark table: {}".format(len(spark_df)))
 
-    ruslana_df = pd.read_parquet(ruslana_path)\
+    ruslana_df = read_parquet_sample(ruslana_path, sample_fraction=sample_fraction, shard=shard, years=years)\
                     .drop_duplicates()
     ruslana_df.columns = [item.lower() for item in ruslana_df.columns]
     ruslana_agg = ruslana_df.drop_duplicates().groupby(["inn", "year"]).count().reset_index().sort_values(by="empl")
     ruslana_agg = ruslana_agg.loc[ruslana_agg.empl == 1].drop("empl", axis=1)
     ruslana_df = ruslana_agg.merge(ruslana_df.drop_duplicates(), on=["inn", "year"], how="left")
+    ruslana_df = apply_schema(ruslana_df, name="ruslana")
     print("Len of Ruslana table: {}".format(len(ruslana_df)))
 
-    gtd_df = prepare_gtd_df(gtd_path)
+    gtd_df = prepare_gtd_df(gtd_path, workers=workers, sample_fraction=sample_fraction, shard=shard, years=customs_years)
+    return spark_df, ruslana_df, gtd_df
+
+
+def build_merged_table(
+        tables: Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame],
+        iv_df: pd.DataFrame,
+        firm_index: pd.DataFrame
+) -> pd.DataFrame:
+    spark_df, ruslana_df, gtd_df = [add_firm_id(df, firm_index) for df in tables]
+    return apply_schema(join_all_tables(spark_df, ruslana_df, gtd_df, iv_df), name="merged table")
+
+
+def export_update_years(update_years: List[int], last_year: int) -> Tuple[List[int], List[int]]:
+    """
+    Годы, экспортные признаки которых меняются при замене данных update_years,
+    и годы GTD, нужные для их пересчета
+    :return: (затронутые годы, годы GTD)
+    """
+    affected = sorted({
+        year + lag for year in update_years for lag in range(EXPORT_LAG_DEPTH + 1) if year + lag <= last_year
+    })
+    context = sorted({
+        year - lag for year in affected for lag in range(EXPORT_LAG_DEPTH + 1) if year - lag >= EXPORT_FIRST_YEAR
+    })
+    return affected, context
+
+
+def update_merged_table(
+        merged: pd.DataFrame,
+        spark_path: str,
+        ruslana_path: str,
+        gtd_path: str,
+        iv_df: pd.DataFrame,
+        firm_index: pd.DataFrame,
+        *,
+        update_years: List[int],
+        workers: int = 1,
+        sample_fraction: Optional[float] = None
+) -> pd.DataFrame:
+    """
+    Заменяет в объединенной таблице прошлого прогона строки лет update_years.
+    Spark и Ruslana читаются только за эти годы. Все признаки, кроме экспортных
+    лагов, считаются внутри (фирма, год); лаги пересчитываются для обновляемых
+    лет и следующих за ними по партициям GTD на EXPORT_LAG_DEPTH лет вокруг них.
+    Результат совпадает с build_merged_table по всем годам
+    """
+    last_year = max(int(merged["year"].max()), max(update_years))
+    affected, context = export_update_years(update_years, last_year)
+    print("Updating years {years}, export features of {affected}".format(years=update_years, affected=affected))
+
+    tables = load_firm_tables(
+        spark_path,
+        ruslana_path,
+        gtd_path,
+        workers=workers,
+        sample_fraction=sample_fraction,
+        years=update_years,
+        customs_years=context
+    )
+    spark_df, ruslana_df, gtd_df = [add_firm_id(df, firm_index) for df in tables]
+
+    fresh = merge_firm_tables(
+        spark_df,
+        ruslana_df,
+        gtd_df.loc[gtd_df["year"].isin(update_years)],
+        iv_df.loc[iv_df["year"].isin(update_years)]
+    )
+    # У остальных затронутых лет меняются только экспортные лаги
+    recompute = pd.concat([
+        fresh,
+        merged.loc[merged["year"].isin(affected) & ~merged["year"].isin(update_years)].drop(columns=EXPORT_FEATURE_COLS)
+    ], ignore_index=True).sort_values(by=["firm_id", "year"], kind="stable", ignore_index=True)
+    recompute = add_export_features(recompute, prepare_export_panel(gtd_df, years=np.asarray(context)))
+
+    df = pd.concat([merged.loc[~merged["year"].isin(affected)], recompute[merged.columns]], ignore_index=True)\
+            .sort_values(by=["firm_id", "year"], ignore_index=True)
+    print("Len of merged table: {}".format(len(df)))
+    return apply_schema(df, name="merged table")
+
+
+def clear_merged_dir(merged_path: str):
+    os.makedirs(merged_path, exist_ok=True)
+    for file_path in glob.glob(os.path.join(merged_path, "*.parquet")):
+        os.remove(file_path)
+
+
+def save_merged_table(df: pd.DataFrame, merged_path: str):
+    """
+    Сохраняет объединенную таблицу до фильтрации: с нее начинается обновление новых лет
+    """
+    clear_merged_dir(merged_path)
+    df.sort_values(by=["firm_id", "year"], ignore_index=True)\
+        .to_parquet(os.path.join(merged_path, "part-0.parquet"), index=False)
+
+
+def load_merged_table(merged_path: str) -> pd.DataFrame:
+    """
+    Объединенная таблица из save_merged_table или из шардов build_sharded
+    """
+    if not os.path.isdir(merged_path) or not glob.glob(os.path.join(merged_path, "*.parquet")):
+        raise FileNotFoundError("No merged table in {path}: run a full build first".format(path=merged_path))
+    return pd.read_parquet(merged_path).sort_values(by=["firm_id", "year"], ignore_index=True)
+
+
+def build_shard(
+        shard: Tuple[int, int],
+        *,
+        spark_path: str,
+        ruslana_path: str,
+        gtd_path: str,
+        iv_df: pd.DataFrame,
+        firm_index: pd.DataFrame,
+        shard_dir: str,
+        sample_fraction: Optional[float] = None,
+        exact_quantiles: bool = False
+) -> Tuple[str, dict]:
+    """
+    Строит объединенную таблицу для фирм одного шарда и сохраняет ее в shard_dir
+    :return: путь к таблице шарда и скетчи квантилей для отсечения выбросов
+    """
+    tables = load_firm_tables(spark_path, ruslana_path, gtd_path, sample_fraction=sample_fraction, shard=shard)
+    df = build_merged_table(tables, iv_df, firm_index)
+
+    shard_path = os.path.join(shard_dir, "shard-{index}.parquet".format(index=shard[0]))
+    df.to_parquet(shard_path, index=False)
+    return shard_path, cutoff_sketches(add_ratios(df), exact=exact_quantiles)
+
+
+def filter_shard(shard_path: str, cutoffs: Dict[str, Tuple[float, float]]) -> pd.DataFrame:
+    return apply_filters(add_ratios(pd.read_parquet(shard_path)), cutoffs)
+
+
+def build_sharded(
+        spark_path: str,
+        ruslana_path: str,
+        gtd_path: str,
+        iv_df: pd.DataFrame,
+        firm_index: pd.DataFrame,
+        *,
+        shards: int,
+        workers: int,
+        shard_dir: str,
+        sample_fraction: Optional[float] = None,
+        cutoffs: Optional[Dict[str, Tuple[float, float]]] = None,
+        exact_quantiles: bool = False
+) -> Tuple[pd.DataFrame, Dict[str, Tuple[float, float]]]:
+    """
+    Строит итоговую таблицу по шардам фирм (хэш ИНН) в пуле процессов.
+    Все шаги до отсечения выбросов делаются внутри фирмы, поэтому шарды
+    независимы; скетчи квантилей шардов сливаются в глобальные пороги,
+    затем шарды фильтруются и объединяются. Таблицы шардов остаются
+    в shard_dir как объединенная таблица для обновления новых лет
+    """
+    shard_list = [(index, shards) for index in range(shards)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                build_shard,
+                shard,
+                spark_path=spark_path,
+                ruslana_path=ruslana_path,
+                gtd_path=gtd_path,
+                iv_df=iv_df,
+                # Каждому шарду нужна только его часть индекса
+                firm_index=sample_firms(firm_index, sample_fraction, shard),
+                shard_dir=shard_dir,
+                sample_fraction=sample_fraction,
+                exact_quantiles=exact_quantiles
+            )
+            for shard in shard_list
+        ]
+        shard_paths, sketches = zip(*[future.result() for future in tqdm(futures)])
+
+        # Глобальные пороги из слитых скетчей шардов
+        merged = sketches[0]
+        for item in sketches[1:]:
+            merged = merge_sketches(merged, item)
+        print("Assets more then 0: {}".format(merged["assets"].count))
+        if cutoffs is None:
+            cutoffs = sketch_cutoffs(merged, FILTER_QUANTILES)
+
+        data = pd.concat(executor.map(partial(filter_shard, cutoffs=cutoffs), shard_paths))\
+                .sort_values(by=["firm_id", "year"])
+    print("Employees no less than 5: {}".format(len(data)))
+
+    data = data.loc[data.year > 2005]
+    print("Dataset length: {}".format(len(data)))
+    return data, cutoffs
+
+
+def main(
+        spark_path: str,
+        ruslana_path: str,
+        gtd_path: str,
+        iv_path: str,
+        output_path: str,
+        workers: int = 1,
+        firm_index_path: Optional[str] = None,
+        sample_fraction: Optional[float] = None,
+        shards: int = 1,
+        exact_quantiles: bool = False,
+        cutoffs_path: Optional[str] = None,
+        reuse_cutoffs: bool = False,
+        merged_path: Optional[str] = None,
+        update_years: Optional[List[int]] = None
+):
+    """
+    :param firm_index_path: общий индекс ИНН -> firm_id (firm_index.py);
+        если не задан, индекс строится по ИНН всех источников
+    :param sample_fraction: доля фирм для быстрого прогона (выборка по хэшу ИНН),
+        у выбранных фирм сохраняются все годы
+    :param shards: число шардов фирм; при shards > 1 шарды строятся в workers процессах
+    :param exact_quantiles: точные квантили для отсечения выбросов вместо скетча при shards > 1
+        (для проверки); без шардов таблица в памяти и квантили всегда точные
+    :param cutoffs_path: файл с использованными порогами (по умолчанию рядом с output_path)
+    :param reuse_cutoffs: применить пороги из cutoffs_path вместо расчета
+    :param merged_path: папка с объединенной таблицей до фильтрации (по умолчанию рядом с output_path)
+    :param update_years: обновить в объединенной таблице только эти годы (нужен firm_index_path,
+        чтобы firm_id не менялись); пороги и фильтры пересчитываются по всей таблице
+    """
+    if cutoffs_path is None:
+        cutoffs_path = "{path}_cutoffs.json".format(path=os.path.splitext(output_path)[0])
+    if merged_path is None:
+        merged_path = "{path}_merged".format(path=os.path.splitext(output_path)[0])
+    cutoffs = load_cutoffs(cutoffs_path) if reuse_cutoffs else None
+    update_years = parse_years(update_years)
+    if update_years is not None and firm_index_path is None:
+        raise ValueError("Update mode needs a stable firm index: pass firm_index_path")
 
     iv_df = prepare_iv_df(iv_path)
 
-    df = join_all_tables(spark_df, ruslana_df, gtd_df, iv_df)
-    data = filter_data(df)
+    if firm_index_path is not None:
+        firm_index = load_firm_index(firm_index_path)
+    else:
+        firm_index = firm_index_from_sources([spark_path, ruslana_path, gtd_path])
+
+    if update_years is not None:
+        merged = update_merged_table(
+            load_merged_table(merged_path),
+            spark_path,
+            ruslana_path,
+            gtd_path,
+            iv_df,
+            firm_index,
+            update_years=update_years,
+            workers=workers,
+            sample_fraction=sample_fraction
+        )
+        save_merged_table(merged, merged_path)
+        data, cutoffs = filter_data(merged, cutoffs)
+    elif shards > 1:
+        clear_merged_dir(merged_path)
+        data, cutoffs = build_sharded(
+            spark_path,
+            ruslana_path,
+            gtd_path,
+            iv_df,
+            firm_index,
+            shards=shards,
+            workers=workers,
+            shard_dir=merged_path,
+            sample_fraction=sample_fraction,
+            cutoffs=cutoffs,
+            exact_quantiles=exact_quantiles
+        )
+    else:
+        tables = load_firm_tables(spark_path, ruslana_path, gtd_path, workers=workers, sample_fraction=sample_fraction)
+        merged = build_merged_table(tables, iv_df, firm_index)
+        save_merged_table(merged, merged_path)
+        data, cutoffs = filter_data(merged, cutoffs)
+
+    if not reuse_cutoffs:
+        exact = exact_quantiles or shards <= 1 or update_years is not None
+        save_cutoffs(cutoffs_path, cutoffs, quantiles=FILTER_QUANTILES, exact=exact)
+
     write_to_csv(data, output_path)
     print("Data saved to {}".format(output_path))
 
@@ -1,14 +1,31 @@
 import os
 import re
+import json
 from tqdm import tqdm
+import numpy as np
 import pandas as pd
 import fire
 import shutil
 from zipfile import ZipFile
-from typing import List
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+try:
+    from py_scripts.incremental import parse_years
+    from py_scripts.process_raw_customs import raw_gtd_years
+    from py_scripts.schema import apply_schema
+    from py_scripts.tariff_cube import build_tariff_cube, dedupe_tariffs, save_tariff_cube
+except ImportError:
+    from incremental import parse_years
+    from process_raw_customs import raw_gtd_years
+    from schema import apply_schema
+    from tariff_cube import build_tariff_cube, dedupe_tariffs, save_tariff_cube
 
 
 pattern_zip = re.compile(r"MFN_(H[0-6])_([A-Z]{3})_(\d{4})\.zip$")
+# Годы панели по умолчанию, если не заданы ни years_of_interest, ни gtd_path
+DEFAULT_YEARS = [2005, 2006, 2007, 2008, 2009]
 
 
 def create_meta_data(folder: str) -> pd.DataFrame:
@@ -32,6 +49,7 @@ def create_meta_data(folder: str) -> pd.DataFrame:
                     country=match.group(2),
                     year=int(match.group(3)),
                     filename=match.group(0),
+                    zip_path=os.path.join(folder, file_name),
                     csv_files=len(csv_files),
                     csv_file=csv_files[0] if len(csv_files) > 0 else None
                 ))
@@ -84,14 +102,63 @@ def unzip_files(folder: str, target_folder: str) -> pd.DataFrame:
     return pd.DataFrame(result)
 
 
+def read_tariff_csv(csv_file: str, zip_path: Optional[str], *, cols: List[str]) -> pd.DataFrame:
+    """
+    Читает нужные колонки таблицы тарифов: из распакованного файла
+    или, если передан zip_path, прямо из архива без распаковки на диск
+    :param csv_file: путь к CSV или имя CSV внутри архива
+    :param zip_path: путь к архиву или None
+    :param cols: колонки для чтения
+    :return:
+    """
+    if zip_path is None:
+        return pd.read_csv(csv_file, usecols=cols).loc[:,cols]
+
+    with ZipFile(zip_path, 'r') as zip_ref, zip_ref.open(csv_file) as source:
+        return pd.read_csv(source, usecols=cols).loc[:,cols]
+
+
 def download_tariffs(
         folder: str,
         *,
-        years_of_interest: List[int] = [2005, 2006, 2007, 2008, 2009],
-        cols: List[str] = ["NomenCode", "Reporter_ISO_N", "Year", "ProductCode", "SimpleAverage"]
+        years_of_interest: List[int] = DEFAULT_YEARS,
+        cols: List[str] = ["NomenCode", "Reporter_ISO_N", "Year", "ProductCode", "SimpleAverage"],
+        streaming: bool = False,
+        workers: int = 1
+    ) -> pd.DataFrame:
+    if streaming:
+        # Читаем CSV прямо из архивов, промежуточная папка не нужна
+        meta_data, _ = create_meta_data(folder)
+        meta_data = meta_data.loc[meta_data["csv_files"] == 1].drop(columns=["csv_files"])
+    else:
+        target_folder = "{folder}_processed".format(folder=folder)
+        meta_data = unzip_files(folder, target_folder)
+
+    return load_tariffs(
+        meta_data,
+        years_of_interest=years_of_interest,
+        cols=cols,
+        streaming=streaming,
+        workers=workers
+    )
+
+
+def load_tariffs(
+        meta_data: pd.DataFrame,
+        *,
+        years_of_interest: List[int] = DEFAULT_YEARS,
+        cols: List[str],
+        streaming: bool,
+        workers: int = 1
     ) -> pd.DataFrame:
-    target_folder = "{folder}_processed".format(folder=folder)
-    meta_data = unzip_files(folder, target_folder)
+    """
+    Протягивает архивы вперед по годам внутри страны и читает таблицы тарифов
+    :param meta_data: метаданные архивов (country, year, csv_file и zip_path для streaming)
+    :return: таблица тарифов и метаданные по годам
+    """
+    if len(meta_data) == 0:
+        print("No tariff files to load")
+        return pd.DataFrame(columns=cols + ["country", "current_year"]), meta_data
 
     years = pd.DataFrame(years_of_interest, columns=["year"])
     result = []
@@ -107,38 +174,255 @@ def download_tariffs(
     result = pd.concat(result).dropna()
     meta_data = result.loc[result["year"].between(years_of_interest[0], years_of_interest[-1])]
 
-    result = []
+    # Займемся выгрузкой: каждый физический файл читаем один раз,
+    # даже если он протянут вперед на несколько лет
+    source_col = "zip_path" if streaming else "csv_file"
+    file_idx, _ = pd.factorize(meta_data[source_col])
+    files = meta_data.drop_duplicates(subset=[source_col])
+
+    zip_paths = files["zip_path"] if streaming else [None] * len(files)
+    read_func = partial(read_tariff_csv, cols=cols)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            tables = list(tqdm(executor.map(read_func, files["csv_file"], zip_paths), total=len(files)))
+    else:
+        tables = [read_func(csv_file, zip_path) for csv_file, zip_path in tqdm(zip(files["csv_file"], zip_paths))]
 
-    # Займемся выгрузкой
-    for _, item in tqdm(meta_data.iterrows()):
-        file_name = item.csv_file
-        current_year = item.year
-        country = item.country
+    # Раздаем прочитанные таблицы всем годам, которые на них ссылаются. Итоговая
+    # таблица (строки файла на каждый год) - единственная копия: concat сразу
+    # собирает ее из ссылок на прочитанные таблицы, без промежуточной таблицы всех файлов
+    row_lengths = np.array([len(table) for table in tables])[file_idx]
 
-        res = pd.read_csv(file_name).loc[:,cols]\
+    result = pd.concat([tables[i] for i in file_idx], ignore_index=True)\
                 .assign(
-                    country=country,
-                    current_year=current_year
+                    country=np.repeat(meta_data["country"].to_numpy(), row_lengths),
+                    current_year=np.repeat(meta_data["year"].to_numpy(), row_lengths)
                 )
-        result.append(res)
 
-    return pd.concat(result), meta_data
+    return result, meta_data
+
+
+MANIFEST_COLS = ["filename", "zip_path", "HS_standard", "country", "year", "size", "mtime", "csv_files", "csv_file", "columns"]
+
+
+def scan_archives(folder: str) -> pd.DataFrame:
+    """
+    Список архивов в папке с размером и временем изменения, без открытия архивов
+    :param folder: путь к папке с .zip файлами
+    :return:
+    """
+    result = []
+    for file_name in os.listdir(folder):
+        match = pattern_zip.search(file_name)
+        if match:
+            zip_path = os.path.join(folder, file_name)
+            stat = os.stat(zip_path)
+            result.append(dict(
+                filename=file_name,
+                zip_path=zip_path,
+                HS_standard=match.group(1),
+                country=match.group(2),
+                year=int(match.group(3)),
+                size=stat.st_size,
+                mtime=stat.st_mtime
+            ))
+
+    return pd.DataFrame(result, columns=MANIFEST_COLS[:7])
+
+
+def inspect_archive(zip_path: str) -> dict:
+    """
+    Находит CSV внутри архива и читает его заголовок
+    :param zip_path: путь к архиву
+    :return:
+    """
+    try:
+        with ZipFile(zip_path, 'r') as zip_ref:
+            csv_files = [f for f in zip_ref.namelist() if f.lower().endswith('.csv')]
+            columns = None
+            if len(csv_files) == 1:
+                with zip_ref.open(csv_files[0]) as source:
+                    columns = ",".join(pd.read_csv(source, nrows=0).columns)
+        return dict(
+            csv_files=len(csv_files),
+            csv_file=csv_files[0] if len(csv_files) > 0 else None,
+            columns=columns
+        )
+    except Exception as e:
+        print(f"Ошибка при обработке архива {zip_path}: {str(e)}")
+        return dict(csv_files=0, csv_file=None, columns=None)
+
+
+def update_manifest(folder: str, manifest_path: str):
+    """
+    Сравнивает архивы в папке с сохраненным манифестом. Открываются только
+    новые архивы и архивы с изменившимся размером или временем изменения
+    :param folder: путь к папке с .zip файлами
+    :param manifest_path: путь к манифесту
+    :return: новый манифест и множество стран, архивы которых изменились
+    """
+    current = scan_archives(folder)
+    if os.path.exists(manifest_path):
+        previous = pd.read_parquet(manifest_path)
+    else:
+        previous = pd.DataFrame(columns=MANIFEST_COLS)
+
+    manifest = current.merge(
+        previous[["filename", "size", "mtime", "csv_files", "csv_file", "columns"]],
+        on=["filename", "size", "mtime"],
+        how="left",
+        indicator=True
+    )
+    is_changed = (manifest["_merge"] == "left_only").to_numpy()
+    manifest = manifest.drop(columns="_merge")
+
+    inspected = [inspect_archive(zip_path) for zip_path in tqdm(manifest.loc[is_changed, "zip_path"])]
+    if inspected:
+        manifest.loc[is_changed, ["csv_files", "csv_file", "columns"]] = pd.DataFrame(
+            inspected, index=manifest.index[is_changed]
+        )
+    manifest = manifest.astype({"csv_files": int})
+
+    removed = previous.loc[~previous["filename"].isin(current["filename"]), "country"]
+    changed_countries = set(manifest.loc[is_changed, "country"]) | set(removed)
+    print("Changed archives: {changed}, removed archives: {removed}".format(changed=is_changed.sum(), removed=len(removed)))
+    return manifest.loc[:, MANIFEST_COLS], changed_countries
+
+
+def manifest_params_path(manifest_path: str) -> str:
+    return "{path}.json".format(path=os.path.splitext(manifest_path)[0])
+
+
+def load_manifest_params(manifest_path: str) -> Optional[dict]:
+    """
+    Годы и колонки, с которыми собрана таблица тарифов прошлого запуска
+    """
+    params_path = manifest_params_path(manifest_path)
+    if not os.path.exists(params_path):
+        return None
+    with open(params_path) as f:
+        return json.load(f)
+
+
+def save_manifest_params(manifest_path: str, *, years_of_interest: List[int], cols: List[str]):
+    with open(manifest_params_path(manifest_path), "w") as f:
+        json.dump(dict(years_of_interest=[int(year) for year in years_of_interest], cols=list(cols)), f)
+
+
+def update_tariffs(
+        folder: str,
+        target_path: str,
+        manifest_path: str,
+        *,
+        years_of_interest: List[int] = DEFAULT_YEARS,
+        cols: List[str],
+        workers: int = 1
+    ):
+    """
+    Инкрементально обновляет таблицу тарифов: перечитываются только страны,
+    у которых появились, изменились или пропали архивы (протягивание
+    по годам зависит от всех архивов страны), остальные строки берутся
+    из существующего tariffs.parquet. Архивы, в заголовке CSV которых
+    (колонка columns манифеста) нет нужных колонок, пропускаются.
+    Если годы или колонки отличаются от сохраненных рядом с манифестом,
+    перечитываются все страны
+    :return: таблица тарифов и новый манифест
+    """
+    manifest, changed_countries = update_manifest(folder, manifest_path)
+    params = dict(years_of_interest=[int(year) for year in years_of_interest], cols=list(cols))
+    is_same_params = load_manifest_params(manifest_path) == params
+    if not is_same_params:
+        print("Tariff years or columns changed, reloading all countries")
+    if os.path.exists(target_path) and is_same_params:
+        existing = pd.read_parquet(target_path)
+        existing = existing.loc[~existing["country"].isin(changed_countries)]
+    else:
+        existing = None
+        changed_countries = set(manifest["country"])
+
+    has_cols = manifest["columns"].fillna("").str.split(",").map(lambda x: set(cols) <= set(x))
+    missing_cols = manifest.loc[(manifest["csv_files"] == 1) & ~has_cols, "filename"]
+    if len(missing_cols) > 0:
+        print("Archives without columns {cols}: {files}".format(cols=", ".join(cols), files=", ".join(missing_cols)))
+
+    meta_data = manifest.loc[
+        manifest["country"].isin(changed_countries) & (manifest["csv_files"] == 1) & has_cols,
+        ["HS_standard", "country", "year", "filename", "zip_path", "csv_file"]
+    ]
+    print("Countries to update: {countries}".format(countries=len(changed_countries)))
+    if len(meta_data) == 0:
+        if existing is None:
+            raise ValueError("No tariff archives with a single CSV and columns {cols} in {folder}".format(
+                cols=", ".join(cols), folder=folder
+            ))
+        return existing, manifest
+
+    df, _ = load_tariffs(
+        meta_data,
+        years_of_interest=years_of_interest,
+        cols=cols,
+        streaming=True,
+        workers=workers
+    )
+    df = pd.concat([existing, df]) if existing is not None else df
+    return df, manifest
 
 
 def main(
         folder: str,
         target_path: str,
-        years_of_interest: List[int] = [2005, 2006, 2007, 2008, 2009],
-        cols: List[str] = ["NomenCode", "Reporter_ISO_N", "Year", "ProductCode", "SimpleAverage"]
+        years_of_interest: Optional[List[int]] = None,
+        cols: List[str] = ["NomenCode", "Reporter_ISO_N", "Year", "ProductCode", "SimpleAverage"],
+        streaming: bool = False,
+        workers: int = 1,
+        incremental: bool = False,
+        cube_path: Optional[str] = None,
+        gtd_path: Optional[str] = None
     ):
-    df, _ = download_tariffs(folder, years_of_interest=years_of_interest, cols=cols)
-    df = df.drop_duplicates()
+    """
+    :param years_of_interest: годы панели, на которые протягиваются тарифы
+    :param gtd_path: папка с сырыми декларациями gtdYYYY.csv: если years_of_interest
+        не заданы, берутся годы этих файлов, чтобы тарифы покрывали все годы деклараций.
+        Без обоих параметров берутся годы DEFAULT_YEARS
+    """
+    years_of_interest = parse_years(years_of_interest)
+    if years_of_interest is None:
+        years_of_interest = raw_gtd_years(gtd_path) if gtd_path is not None else DEFAULT_YEARS
+    print("Tariff years: {years}".format(years=", ".join(map(str, years_of_interest))))
+    if incremental:
+        # Манифест архивов лежит рядом с таблицей тарифов
+        manifest_path = "{path}_manifest.parquet".format(path=os.path.splitext(target_path)[0])
+        df, manifest = update_tariffs(
+            folder,
+            target_path,
+            manifest_path,
+            years_of_interest=years_of_interest,
+            cols=cols,
+            workers=workers
+        )
+    else:
+        df, _ = download_tariffs(
+            folder,
+            years_of_interest=years_of_interest,
+            cols=cols,
+            streaming=streaming,
+            workers=workers
+        )
+    # Один тариф на (репортер, товар, год): повторы из разных номенклатур усредняются
+    df = dedupe_tariffs(apply_schema(df.drop_duplicates(), name="tariffs"))
 
     # Уберем страны без вариации тарифов!
     # bad_countries = df.loc[(df.current_year == 2009) & (df.Year <= 2005), "country"].unique()
     # df = df.loc[~df["country"].isin(bad_countries)]
 
     df.to_parquet(target_path, index=False)
+    if cube_path is not None:
+        # Плотный куб тарифов для поиска без merge (см. tariff_cube.py)
+        save_tariff_cube(build_tariff_cube(df), cube_path)
+    if incremental:
+        # Манифест и параметры сборки сохраняем только после успешной записи тарифов
+        manifest.to_parquet(manifest_path, index=False)
+        save_manifest_params(manifest_path, years_of_interest=years_of_interest, cols=cols)
 
 
 if __name__ == "__main__":
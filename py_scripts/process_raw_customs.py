@@ -1,12 +1,39 @@
 import os
+import re
 import fire
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, Optional, Tuple
+
+try:
+    from py_scripts.incremental import parse_years
+    from py_scripts.sampling import sample_filter, sample_mask
+    from py_scripts.schema import apply_schema
+except ImportError:
+    from incremental import parse_years
+    from sampling import sample_filter, sample_mask
+    from schema import apply_schema
 
 DATA_DIR = "/Users/mac/Desktop/Study/Diploma/data"
 COUNTRIES_DIR = os.path.join(DATA_DIR, "countries")
 WITS_PATH = os.path.join(COUNTRIES_DIR, "WITS_codes.xlsx")
 RUS_PATH = os.path.join(COUNTRIES_DIR, "rus_countries.csv")
 YUGOSLAVIA = [499, 688]
+# Текстовые поля читаем строками, чтобы тип не зависел от куска файла
+READ_DTYPES = {"g021": str, "g17a": str, "g33": str}
+ROW_GROUP_SIZE = 500_000
+# Грубая оценка памяти на год: таблица pandas занимает в несколько раз больше CSV,
+# при потоковой обработке в памяти один кусок (байт на строку CSV - с запасом)
+CSV_MEMORY_FACTOR = 4
+CSV_ROW_BYTES = 300
+# Строк в row group-е отсортированных серий: при слиянии в памяти по одному такому куску на серию
+MERGE_BATCH_ROWS = 50_000
+pattern_gtd = re.compile(r"^gtd(\d{4})\.csv$")
 
 """
 Описание полей входной таблицы:
@@ -19,63 +46,404 @@ YUGOSLAVIA = [499, 688]
 """
 
 
-def process_code(item, *, name_to_code, all_codes):
-    if str(item).isalpha():
-        if item == "АВ":
-             item = "AB"
-        code = name_to_code.get(item, 0)
-    else:
-        item = int(item)
-        code = item if item in all_codes else 0
-        
-    return code if not code in YUGOSLAVIA else 891
+def load_country_codes(countries_path: str = RUS_PATH):
+    """
+    Один раз строит справочник кодов стран из rus_countries.csv,
+    включая особые случаи (кириллическое "АВ" вместо "AB")
+    """
+    codes = pd.read_csv(countries_path)
+    all_codes = set(codes["code"].unique())
+    name_to_code = {key: val for key, val in zip(codes["RUS_ISO2"], codes["code"])}
+    if "AB" in name_to_code:
+        name_to_code["АВ"] = name_to_code["AB"]
+    return name_to_code, all_codes
 
 
-def process_product_code(item):
-    try:
-        item = int(item)
-        return item // 10000
-    except ValueError:
-        return None
+def process_code(g17a: pd.Series, *, name_to_code, all_codes) -> np.ndarray:
+    """
+    Переводит g17a (буквенный или цифровой код страны) в цифровой код.
+    Каждое уникальное значение разрешается один раз, строки получают
+    код индексированием по кодам factorize
+    """
+    idx, values = pd.factorize(g17a)
+    values = pd.Series(values, dtype=object).astype(str)
+    is_alpha = values.str.isalpha()
 
+    codes = pd.Series(0, index=values.index, dtype="int64")
+    codes[is_alpha] = values[is_alpha].map(name_to_code).fillna(0).astype("int64")
+    numeric = values[~is_alpha].astype("int64")
+    codes[~is_alpha] = numeric.where(numeric.isin(list(all_codes)), 0)
+
+    codes = codes.where(~codes.isin(YUGOSLAVIA), 891)
+    return codes.to_numpy()[idx]
 
-def return_cleaned_data(data_path):
-    data = pd.read_csv(data_path, low_memory=False)\
-            .drop(columns=["Unnamed: 0", "nd", "g012", "g15a"]) # Пока не дропаем g33
-    print(len(data))
+
+def process_product_code(g33: pd.Series) -> pd.Series:
+    """
+    Код товара из первых шести знаков ТНВЭД, нечисловые коды дают пропуск.
+    Разбор чисел делается по уникальным кодам, целочисленное деление по всей колонке
+    """
+    idx, values = pd.factorize(g33)
+    values = pd.Series(values, dtype=object).astype(str)
+    is_integer = values.str.fullmatch(r"\s*[-+]?\d+\s*")
+    parsed = pd.to_numeric(values.where(is_integer), errors="coerce").to_numpy(dtype="float64")
+
+    # Пропуски в factorize имеют индекс -1 и попадают на добавленный NaN
+    product = np.append(parsed, np.nan)[idx] // 10000
+    return pd.Series(product, index=g33.index)
+
+
+def clean_data(
+        data: pd.DataFrame,
+        *,
+        name_to_code,
+        all_codes,
+        verbose: bool = True,
+        sample_fraction: Optional[float] = None
+) -> pd.DataFrame:
+    data = data.drop(columns=["Unnamed: 0", "nd", "g012", "g15a"]) # Пока не дропаем g33
 
     # Избавляемся от пустых значений
     data = data.dropna(subset=["g021", "g17a", "g46"])
-    data = data[data.g021.str.isnumeric()].assign(g021=lambda x: x.g021.astype(int))
-    print(len(data))
+    data = data[data.g021.str.isnumeric()].assign(g021=lambda x: x.g021.astype("int64"))
+    if sample_fraction is not None:
+        data = data.loc[sample_mask(data.g021, sample_fraction)]
+    if not pd.api.types.is_numeric_dtype(data.g46):
+        data = data.assign(g46=lambda x: x.g46.astype(str).str.replace(',', '.').astype(float))
+    if verbose:
+        print(len(data))
 
     # Обрабатываем коды стран
-    codes = pd.read_csv(RUS_PATH)
-    all_codes = set(codes["code"].unique())
-    name_to_code = {key: val for key, val in zip(codes["RUS_ISO2"], codes["code"])}
-    func = lambda x: process_code(x, name_to_code=name_to_code, all_codes=all_codes)
     data = data.assign(
-        code=lambda x: x.g17a.map(func),
-        product=lambda x: x.g33.map(process_product_code, na_action="ignore"),
+        code=lambda x: process_code(x.g17a, name_to_code=name_to_code, all_codes=all_codes),
+        product=lambda x: process_product_code(x.g33),
     )
     data = data.loc[~data.code.isin([0, 643])] # 643 - Россия, 0 - неизвестно
-    print("Final size is {}".format(len(data)))
+    if verbose:
+        print("Final size is {}".format(len(data)))
 
     to_rename = {"g021": "INN", "g46": "value"}
     return data.drop(columns=["g023", "g17a", "g072", "gd1", "g34", "g33"])\
                 .rename(columns=to_rename)
 
 
-def main(data_path: str, output_path: str):
-    years = [2005, 2006, 2007, 2008, 2009]
+def return_cleaned_data(data_path, sample_fraction: Optional[float] = None, country_codes=None):
+    data = pd.read_csv(data_path, dtype=READ_DTYPES, low_memory=False)
+    print(len(data))
+
+    name_to_code, all_codes = country_codes if country_codes is not None else load_country_codes()
+    return clean_data(data, name_to_code=name_to_code, all_codes=all_codes, sample_fraction=sample_fraction)
+
+
+def stream_cleaned_data(
+        data_path: str,
+        output_path: str,
+        *,
+        year: int,
+        chunksize: int,
+        partitioned: bool = False,
+        sample_fraction: Optional[float] = None,
+        country_codes=None
+):
+    """
+    Потоково очищает годовой CSV деклараций: файл читается кусками по chunksize
+    строк, каждый очищенный кусок дописывается в parquet отдельной row group,
+    так что пиковая память определяется размером куска, а не файла.
+    В режиме partitioned год задается путем партиции: куски сортируются по INN
+    и пишутся сериями во временный файл, затем серии сливаются в партицию
+    (merge_sorted_runs), так что и сортировка года не читает его в память целиком
+    """
+    name_to_code, all_codes = country_codes if country_codes is not None else load_country_codes()
+
+    writer = None
+    # В режиме partitioned куски пишутся во временный файл серий, длины серий - в run_rows
+    target_path = "{path}.runs".format(path=output_path) if partitioned else output_path
+    run_rows = []
+    total_read, total_kept = 0, 0
+    try:
+        for i, chunk in enumerate(pd.read_csv(data_path, dtype=READ_DTYPES, chunksize=chunksize, low_memory=False)):
+            data = apply_schema(clean_data(
+                chunk,
+                name_to_code=name_to_code,
+                all_codes=all_codes,
+                verbose=False,
+                sample_fraction=sample_fraction
+            ))
+            if partitioned:
+                table = sort_by_inn(pa.Table.from_pandas(data, preserve_index=False))
+            else:
+                table = pa.Table.from_pandas(apply_schema(data.assign(year=year)), preserve_index=True)
+            if writer is None:
+                writer = pq.ParquetWriter(target_path, table.schema)
+            if len(data) > 0:
+                if partitioned:
+                    writer.write_table(table.cast(writer.schema), row_group_size=MERGE_BATCH_ROWS)
+                    run_rows.append(len(data))
+                else:
+                    writer.write_table(table.cast(writer.schema))
+
+            total_read += len(chunk)
+            total_kept += len(data)
+            print("Chunk {i}: {read} rows read, {kept} rows kept".format(i=i, read=len(chunk), kept=len(data)))
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if partitioned and writer is not None:
+        merge_sorted_runs(target_path, run_rows, output_path)
+        os.remove(target_path)
+    print("Total: {read} rows read, final size is {kept}".format(read=total_read, kept=total_kept))
+
+
+def sort_by_inn(table: pa.Table) -> pa.Table:
+    # sort_indices устойчива: строки с одним INN сохраняют исходный порядок
+    return table.take(pc.sort_indices(table, sort_keys=[("INN", "ascending")]))
+
+
+def merge_sorted_runs(runs_path: str, run_rows: List[int], output_path: str):
+    """
+    Слияние k отсортированных по INN серий из runs_path в файл партиции, отсортированный
+    целиком. Если сортировать только куски, row group-ы пересекаются по INN и статистики
+    min/max не отсекают ничего. В памяти по одному row group-у (MERGE_BATCH_ROWS строк)
+    на серию и выходной row group. За шаг выдаются все строки с INN меньше последнего
+    INN в буфере одной из незаконченных серий: строк с таким INN дальше нет ни в одной серии.
+    Строки с одним INN идут в порядке серий, поэтому порядок тот же, что при устойчивой
+    сортировке всего года
+    :param run_rows: число строк в каждой серии в порядке записи
+    """
+    parquet = pq.ParquetFile(runs_path)
+    # Row group-ы каждой серии по накопленному числу строк
+    group_ends = np.cumsum([parquet.metadata.row_group(i).num_rows for i in range(parquet.metadata.num_row_groups)])
+    run_ends = np.cumsum(run_rows)
+    run_idx = np.searchsorted(run_ends, group_ends, side="left")
+    queues = [list(np.flatnonzero(run_idx == run)) for run in range(len(run_rows))]
+    buffers = [parquet.read_row_group(queue.pop(0)) for queue in queues]
+
+    writer = pq.ParquetWriter(output_path, parquet.schema_arrow)
+    pending = []
 
-    for year in years:
-        print(20 * '-')
-        print("Processing {year}".format(year=year))
-        data = return_cleaned_data(os.path.join(data_path, "gtd{year}.csv".format(year=year)))\
+    def write(pieces, final=False):
+        table = pa.concat_tables(pieces) if pieces else parquet.schema_arrow.empty_table()
+        while table.num_rows >= ROW_GROUP_SIZE or (final and table.num_rows > 0):
+            writer.write_table(table.slice(0, ROW_GROUP_SIZE), row_group_size=ROW_GROUP_SIZE)
+            table = table.slice(ROW_GROUP_SIZE)
+        return [table] if table.num_rows > 0 else []
+
+    try:
+        while buffers:
+            open_runs = [i for i, queue in enumerate(queues) if queue]
+            bound_run = min(open_runs, key=lambda i: buffers[i]["INN"][-1].as_py()) if open_runs else None
+            bound = buffers[bound_run]["INN"][-1].as_py() if open_runs else None
+
+            pieces = []
+            for i, buffer in enumerate(buffers):
+                n_rows = buffer.num_rows if bound is None else \
+                        int(np.searchsorted(buffer["INN"].to_numpy(), bound, side="left"))
+                pieces.append(buffer.slice(0, n_rows))
+                buffers[i] = buffer.slice(n_rows)
+            pending = write(pending + [sort_by_inn(pa.concat_tables(pieces))])
+
+            if bound is None:
+                break
+            buffers[bound_run] = pa.concat_tables([buffers[bound_run], parquet.read_row_group(queues[bound_run].pop(0))])
+            # Закончившиеся серии больше не участвуют
+            keep = [i for i in range(len(buffers)) if buffers[i].num_rows > 0 or queues[i]]
+            buffers, queues = [buffers[i] for i in keep], [queues[i] for i in keep]
+        write(pending, final=True)
+    finally:
+        writer.close()
+
+
+def gtd_year_path(output_path: str, year: int, partitioned: bool) -> str:
+    """
+    Путь к файлу года: gtdYYYY.parquet или партиция year=YYYY hive-датасета
+    """
+    if not partitioned:
+        return os.path.join(output_path, "gtd{year}.parquet".format(year=year))
+
+    partition_dir = os.path.join(output_path, "year={year}".format(year=year))
+    os.makedirs(partition_dir, exist_ok=True)
+    return os.path.join(partition_dir, "part-0.parquet")
+
+
+def read_gtd(
+        gtd_path: str,
+        *,
+        years: Optional[List[int]] = None,
+        columns: Optional[List[str]] = None,
+        sample_fraction: Optional[float] = None,
+        shard: Optional[Tuple[int, int]] = None
+) -> pd.DataFrame:
+    """
+    Читает обработанные декларации: hive-датасет по годам, папку gtdYYYY.parquet
+    или отдельный файл. Фильтр по годам и выбор колонок проталкиваются в чтение,
+    так что с диска читаются только нужные партиции и колонки
+    :param gtd_path: путь к датасету или файлу
+    :param years: годы для чтения (по умолчанию все)
+    :param columns: колонки для чтения без учета регистра (по умолчанию все)
+    :param sample_fraction: доля фирм для выборки по хэшу ИНН (по умолчанию все фирмы)
+    :param shard: (номер шарда, число шардов) - часть фирм по тому же хэшу
+    """
+    dataset = ds.dataset(gtd_path, format="parquet", partitioning="hive")
+    if columns is not None:
+        columns = [item for item in dataset.schema.names if item.lower() in [col.lower() for col in columns]]
+    row_filter = ds.field("year").isin(years) if years is not None else None
+    if sample_fraction is not None or shard is not None:
+        inn_column = [item for item in dataset.schema.names if item.lower() == "inn"][0]
+        sample = sample_filter(inn_column, sample_fraction, shard)
+        row_filter = sample if row_filter is None else row_filter & sample
+
+    df = dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+    if "year" in df.columns:
+        df = df.assign(year=lambda x: x["year"].astype("int64"))
+    return df
+
+
+def raw_gtd_years(data_path: str) -> List[int]:
+    """
+    Годы сырых деклараций по именам файлов gtdYYYY.csv в папке data_path
+    """
+    matches = [pattern_gtd.match(file_name) for file_name in os.listdir(data_path)]
+    return sorted(int(match.group(1)) for match in matches if match)
+
+
+def gtd_years(gtd_path: str) -> List[int]:
+    dataset = ds.dataset(gtd_path, format="parquet", partitioning="hive")
+    return sorted(pc.unique(dataset.to_table(columns=["year"])["year"]).to_pylist())
+
+
+def process_year(
+        year: int,
+        *,
+        data_path: str,
+        output_path: str,
+        chunksize: Optional[int] = None,
+        partitioned: bool = False,
+        sample_fraction: Optional[float] = None,
+        country_codes=None
+) -> int:
+    """
+    Обрабатывает CSV деклараций одного года в parquet
+    :param country_codes: справочник из load_country_codes, загруженный один раз на все годы
+    :return: год
+    """
+    print(20 * '-')
+    print("Processing {year}".format(year=year))
+    csv_path = os.path.join(data_path, "gtd{year}.csv".format(year=year))
+    parquet_path = gtd_year_path(output_path, year, partitioned)
+    if chunksize is not None:
+        stream_cleaned_data(
+            csv_path,
+            parquet_path,
+            year=year,
+            chunksize=chunksize,
+            partitioned=partitioned,
+            sample_fraction=sample_fraction,
+            country_codes=country_codes
+        )
+    elif partitioned:
+        # Сортировка по INN дает узкие min/max INN в статистиках row group
+        data = apply_schema(return_cleaned_data(csv_path, sample_fraction, country_codes), name="gtd{year}".format(year=year))\
+                    .sort_values(by="INN", kind="stable")
+        data.to_parquet(parquet_path, index=False, row_group_size=ROW_GROUP_SIZE)
+    else:
+        data = return_cleaned_data(csv_path, sample_fraction, country_codes)\
                     .assign(year=year)
-        data = data.to_parquet(os.path.join(output_path, "gtd{year}.parquet".format(year=year)))
+        data = apply_schema(data, name="gtd{year}".format(year=year))
+        data.to_parquet(parquet_path)
+    return year
+
+
+def year_memory_gb(csv_path: str, chunksize: Optional[int] = None, partitioned: bool = False) -> float:
+    """
+    Оценка пиковой памяти на обработку года по размеру CSV
+    """
+    size = os.path.getsize(csv_path)
+    if chunksize is None:
+        return size * CSV_MEMORY_FACTOR / 2 ** 30
+    # Слияние отсортированных серий партиции читает их по row group-ам и память не добавляет
+    return min(size, chunksize * CSV_ROW_BYTES) * CSV_MEMORY_FACTOR / 2 ** 30
+
+
+def process_years_parallel(
+        years: List[int],
+        *,
+        workers: int,
+        memory_budget_gb: Optional[float] = None,
+        **kwargs
+):
+    """
+    Обрабатывает годы в пуле процессов. Большие годы запускаются первыми,
+    новый год стартует, только если оценка памяти запущенных годов
+    укладывается в бюджет (один год запускается всегда)
+    :param kwargs: аргументы process_year
+    """
+    memory = {
+        year: year_memory_gb(
+            os.path.join(kwargs["data_path"], "gtd{year}.csv".format(year=year)),
+            kwargs.get("chunksize"),
+            kwargs.get("partitioned", False)
+        )
+        for year in years
+    }
+    pending = sorted(years, key=lambda year: memory[year], reverse=True)
+    running = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            in_flight = sum(memory[year] for year in running.values())
+            for year in list(pending):
+                if len(running) >= workers:
+                    break
+                fits = memory_budget_gb is None or in_flight + memory[year] <= memory_budget_gb
+                if fits or not running:
+                    pending.remove(year)
+                    running[executor.submit(process_year, year, **kwargs)] = year
+                    in_flight += memory[year]
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                year = running.pop(future)
+                future.result()
+                print("Finished {year}".format(year=year))
+
+
+def main(
+        data_path: str,
+        output_path: str,
+        chunksize: Optional[int] = None,
+        partitioned: bool = False,
+        sample_fraction: Optional[float] = None,
+        workers: int = 1,
+        memory_budget_gb: Optional[float] = None,
+        years: Optional[List[int]] = None,
+        countries_path: str = RUS_PATH
+):
+    """
+    :param workers: число годов, обрабатываемых параллельно
+    :param memory_budget_gb: ограничение оценки памяти одновременно обрабатываемых годов
+    :param years: годы для обработки (по умолчанию все файлы gtdYYYY.csv в data_path).
+        Каждый год пишется в свой файл, так что новый год добавляется без пересчета остальных
+    :param countries_path: справочник стран rus_countries.csv
+    """
+    years = parse_years(years) or raw_gtd_years(data_path)
+    if not years:
+        raise ValueError("No gtdYYYY.csv files in {path}".format(path=data_path))
+
+    # Справочник стран читается один раз и передается во все годы
+    kwargs = dict(
+        data_path=data_path,
+        output_path=output_path,
+        chunksize=chunksize,
+        partitioned=partitioned,
+        sample_fraction=sample_fraction,
+        country_codes=load_country_codes(countries_path)
+    )
+    if workers > 1:
+        process_years_parallel(years, workers=workers, memory_budget_gb=memory_budget_gb, **kwargs)
+    else:
+        for year in years:
+            process_year(year, **kwargs)
 
 
 if __name__ == "__main__":
-    fire.Fire(main)
\ No newline at end of file
+    fire.Fire(main)
@@ -1,30 +1,66 @@
 import os
-import re
+import csv
 import fire
+import numpy as np
+import threading
 import pandas as pd
-from typing import Optional
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 
+try:
+    from py_scripts.incremental import parse_years, replace_years
+    from py_scripts.sampling import sample_firms
+    from py_scripts.schema import apply_schema
+except ImportError:
+    from incremental import parse_years, replace_years
+    from sampling import sample_firms
+    from schema import apply_schema
 
-def extract_okved(item: str) -> str:
-    item = str(item).strip()
-    match = re.search(r'\b\d{2}\.\d{2}\b', item)
-    return match.group(0) if match else None
 
+def extract_okved(okved: pd.Series) -> pd.Series:
+    """
+    Выделяет четырехзначный код ОКВЭД. Регулярное выражение применяется
+    один раз к каждому уникальному значению, результат - категориальная
+    колонка с настоящими пропусками
+    """
+    idx, values = pd.factorize(okved)
+    extracted = pd.Series(values, dtype=object).astype(str).str.strip()\
+                    .str.extract(r'\b(\d{2}\.\d{2})\b', expand=False)\
+                    .astype("category")
 
-def process_raw_data(df: pd.DataFrame, *, source: str="CUR") -> pd.DataFrame:
-    COLUMNS = [
-        "INN",
-        "OKVED",
-        "Year",
-        "Form_1_Field_290",
-        "Form_1_Field_300",
-        "Form_2_Field_010",
-        "Form_2_Field_190",
-        "Form_1_Field_510",
-        "Form_1_Field_610",
-        "Form_1_Field_625"
-    ]
+    # Пропуски в factorize имеют индекс -1 и попадают на добавленный код -1
+    codes = np.append(extracted.cat.codes.to_numpy(), -1)[idx]
+    return pd.Series(pd.Categorical.from_codes(codes, categories=extracted.cat.categories), index=okved.index)
 
+
+COLUMNS = [
+    "INN",
+    "OKVED",
+    "Year",
+    "Form_1_Field_290",
+    "Form_1_Field_300",
+    "Form_2_Field_010",
+    "Form_2_Field_190",
+    "Form_1_Field_510",
+    "Form_1_Field_610",
+    "Form_1_Field_625"
+]
+
+# Типы колонок для колоночного чтения CSV (Source нужен только для фильтра)
+ARROW_TYPES = {
+    "Source": pa.string(),
+    "INN": pa.float64(),
+    "OKVED": pa.string(),
+    "Year": pa.int64(),
+    **{col: pa.float64() for col in COLUMNS if col.startswith("Form_")}
+}
+
+
+def process_raw_data(df: pd.DataFrame, *, source: str="CUR", years: Optional[List[int]]=None) -> pd.DataFrame:
     TO_RENAME = dict(
         Form_1_Field_290="tang_assets", 
         Form_1_Field_300="assets",
@@ -37,7 +73,10 @@ def process_raw_data(df: pd.DataFrame, *, source: str="CUR") -> pd.DataFrame:
 
     DROPNA_SUBSET = ["INN", "assets"] # short_debt, long_debt
 
-    return df.loc[(df.Source == source) & (df.Year > 2004), COLUMNS]\
+    mask = (df.Source == source) & (df.Year > 2004)
+    if years is not None:
+        mask = mask & df.Year.isin(years)
+    return df.loc[mask, COLUMNS]\
             .rename(columns=TO_RENAME)\
             .dropna(subset=DROPNA_SUBSET)\
             .assign(
@@ -45,14 +84,150 @@ def process_raw_data(df: pd.DataFrame, *, source: str="CUR") -> pd.DataFrame:
                 short_debt=lambda x: x.short_debt.fillna(0),
                 long_debt=lambda x: x.long_debt.fillna(0),
                 debt=lambda x: x.short_debt + x.long_debt,
-                okved_four=lambda x: x.OKVED.map(extract_okved, na_action="ignore").astype(str),
+                okved_four=lambda x: extract_okved(x.OKVED),
                 OKVED=lambda x: x.OKVED.astype(str)
             )\
             .drop(columns=["short_debt_others"])
 
 
-def main(data_dir: str, output_path: str=None, source: str="CUR") -> Optional[pd.DataFrame]:
+def missing_columns(file_path: str) -> List[str]:
+    """
+    Колонки ARROW_TYPES, которых нет в заголовке CSV
+    """
+    with open(file_path, newline="", encoding="utf-8", errors="replace") as f:
+        header = next(csv.reader(f, delimiter=";"), [])
+    return [col for col in ARROW_TYPES if col not in header]
+
+
+def read_filtered_batches(
+        file_path: str,
+        *,
+        source: str="CUR",
+        sample_fraction: Optional[float]=None,
+        years: Optional[List[int]]=None
+):
+    """
+    Потоково читает CSV Spark многопоточным колоночным ридером arrow:
+    только нужные колонки с явными типами, фильтр по Source и Year
+    применяется к каждому батчу до перевода в pandas
+    """
+    reader = pacsv.open_csv(
+        file_path,
+        read_options=pacsv.ReadOptions(use_threads=True),
+        parse_options=pacsv.ParseOptions(delimiter=';'),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=list(ARROW_TYPES),
+            column_types=ARROW_TYPES,
+            strings_can_be_null=True
+        )
+    )
+    for batch in reader:
+        mask = pc.and_(pc.equal(batch["Source"], source), pc.greater(batch["Year"], 2004))
+        if years is not None:
+            mask = pc.and_(mask, pc.is_in(batch["Year"], pa.array(years, pa.int64())))
+        batch = batch.filter(mask)
+        if batch.num_rows > 0:
+            yield apply_schema(sample_firms(process_raw_data(batch.to_pandas(), source=source, years=years), sample_fraction))
+
+
+def process_files_arrow(
+        files,
+        output_path: str,
+        *,
+        source: str="CUR",
+        workers: int=4,
+        sample_fraction: Optional[float]=None,
+        years: Optional[List[int]]=None
+) -> int:
+    """
+    Обрабатывает файлы параллельно и дописывает результат в parquet
+    по мере готовности батчей, не собирая всю таблицу в памяти.
+    Запись идет во временный файл, который переименовывается в output_path
+    только после успешной обработки всех файлов. Файл без нужных колонок
+    (по заголовку) пропускается, как в pandas-ветке; любая ошибка чтения
+    или преобразования данных прерывает весь запуск
+    """
+    writer = None
+    lock = threading.Lock()
+    tmp_path = "{path}.tmp".format(path=output_path)
+
+    def process_file(file_path):
+        nonlocal writer
+        missing = missing_columns(file_path)
+        if missing:
+            print("Failed to process {file}: missing columns {cols}".format(
+                file=os.path.basename(file_path), cols=", ".join(missing)
+            ))
+            return 0
+
+        n_rows = 0
+        for df in read_filtered_batches(file_path, source=source, sample_fraction=sample_fraction, years=years):
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            with lock:
+                if writer is None:
+                    # Словари категорий различаются между батчами, фиксируем ширину индексов
+                    schema = pa.schema([
+                        pa.field(field.name, pa.dictionary(pa.int32(), field.type.value_type))
+                        if pa.types.is_dictionary(field.type) else field
+                        for field in table.schema
+                    ], metadata=table.schema.metadata)
+                    writer = pq.ParquetWriter(tmp_path, schema)
+                writer.write_table(table.cast(writer.schema))
+            n_rows += len(df)
+        print("Processed {file}: {rows} rows".format(file=os.path.basename(file_path), rows=n_rows))
+        return n_rows
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            total = sum(executor.map(process_file, files))
+    except BaseException:
+        if writer is not None:
+            writer.close()
+            os.remove(tmp_path)
+        raise
+    if writer is not None:
+        writer.close()
+        os.replace(tmp_path, output_path)
+    return total
+
+
+def main(
+        data_dir: str,
+        output_path: str=None,
+        source: str="CUR",
+        engine: str="pandas",
+        workers: int=4,
+        sample_fraction: Optional[float]=None,
+        update_years: Optional[List[int]]=None
+) -> Optional[pd.DataFrame]:
+    """
+    :param update_years: обработать только строки этих лет и заменить ими
+        строки тех же лет в уже существующем output_path
+    """
     files = os.listdir(data_dir)
+    update_years = parse_years(update_years)
+
+    if engine == "arrow":
+        assert output_path is not None, "Arrow engine writes directly to output_path"
+        files = [os.path.join(data_dir, file_name) for file_name in files if file_name.endswith(".csv")]
+        target_path = output_path if update_years is None else "{path}.update".format(path=output_path)
+        total = process_files_arrow(
+            files,
+            target_path,
+            source=source,
+            workers=workers,
+            sample_fraction=sample_fraction,
+            years=update_years
+        )
+        print("All files processed!")
+        print(total)
+        if update_years is not None:
+            # Если строк новых лет нет, файл обновления не создается
+            new = pd.read_parquet(target_path) if os.path.exists(target_path) else pd.DataFrame()
+            apply_schema(replace_years(output_path, new, update_years), name="spark").to_parquet(output_path, index=False)
+            if os.path.exists(target_path):
+                os.remove(target_path)
+        return
 
     result = []
     for file_name in files:
@@ -60,7 +235,7 @@ def main(data_dir: str, output_path: str=None, source: str="CUR") -> Optional[pd
             print("Processing {file}".format(file=file_name))
             try:
                 df = pd.read_csv(os.path.join(data_dir, file_name), sep=';', low_memory=False)
-                df = process_raw_data(df, source=source)
+                df = sample_firms(process_raw_data(df, source=source, years=update_years), sample_fraction)
                 print(df.shape)
                 result.append(df)
             except KeyError as e:
@@ -69,6 +244,9 @@ def main(data_dir: str, output_path: str=None, source: str="CUR") -> Optional[pd
     print("All files processed!")
 
     result = pd.concat(result)
+    if update_years is not None and output_path is not None:
+        result = replace_years(output_path, result, update_years)
+    result = apply_schema(result, name="spark")
     print(len(result))
     if output_path is not None:
         result.to_parquet(output_path, index=False)
@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from typing import List, Optional, Tuple
+
+# Мультипликативный хэш ИНН: старшие 32 бита произведения на константу Фибоначчи.
+# Одни и те же ИНН попадают в выборку во всех скриптах и при любом порядке строк
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+HASH_SHIFT = 32
+
+
+def sample_threshold(fraction: float) -> int:
+    if not 0. < fraction <= 1.:
+        raise ValueError("Sample fraction must be in (0, 1], got {fraction}".format(fraction=fraction))
+    return int(fraction * 2 ** HASH_SHIFT)
+
+
+def firm_hash_range(
+        sample_fraction: Optional[float] = None,
+        shard: Optional[Tuple[int, int]] = None
+) -> Optional[Tuple[int, int]]:
+    """
+    Диапазон хэшей [start, stop) для выборки фирм и шарда внутри нее
+    :param sample_fraction: доля фирм (по умолчанию все)
+    :param shard: (номер шарда, число шардов)
+    :return: границы диапазона или None, если фильтровать не нужно
+    """
+    if sample_fraction is None and shard is None:
+        return None
+    stop = sample_threshold(1. if sample_fraction is None else sample_fraction)
+    if shard is None:
+        return 0, stop
+
+    index, n_shards = shard
+    if not 0 <= index < n_shards:
+        raise ValueError("Shard {index} is out of range for {n_shards} shards".format(index=index, n_shards=n_shards))
+    return stop * index // n_shards, stop * (index + 1) // n_shards
+
+
+def inn_hash(inns) -> np.ndarray:
+    inns = np.asarray(inns, dtype=np.int64).astype(np.uint64)
+    return (inns * np.uint64(HASH_MULTIPLIER)) >> np.uint64(HASH_SHIFT)
+
+
+def sample_mask(
+        inns,
+        fraction: Optional[float] = None,
+        shard: Optional[Tuple[int, int]] = None
+) -> np.ndarray:
+    """
+    Маска фирм, попавших в выборку доли fraction (и в шард shard)
+    """
+    start, stop = firm_hash_range(fraction, shard) or (0, 2 ** HASH_SHIFT)
+    hashed = inn_hash(inns)
+    return (hashed >= start) & (hashed < stop)
+
+
+def sample_firms(
+        df: pd.DataFrame,
+        fraction: Optional[float],
+        shard: Optional[Tuple[int, int]] = None
+) -> pd.DataFrame:
+    """
+    Оставляет строки фирм из выборки (колонка ИНН ищется без учета регистра)
+    """
+    if fraction is None and shard is None:
+        return df
+    column = [item for item in df.columns if str(item).lower() == "inn"][0]
+    return df.loc[sample_mask(df[column], fraction, shard)]
+
+
+def sample_filter(
+        column: str,
+        fraction: Optional[float],
+        shard: Optional[Tuple[int, int]] = None
+) -> Optional[ds.Expression]:
+    """
+    Тот же хэш в виде выражения arrow для фильтра при чтении parquet
+    """
+    hash_range = firm_hash_range(fraction, shard)
+    if hash_range is None:
+        return None
+    hashed = pc.shift_right(
+        pc.multiply(ds.field(column).cast(pa.uint64()), pa.scalar(HASH_MULTIPLIER, pa.uint64())),
+        pa.scalar(HASH_SHIFT, pa.uint64())
+    )
+    start, stop = [pa.scalar(bound, pa.uint64()) for bound in hash_range]
+    return (hashed >= start) & (hashed < stop)
+
+
+def read_parquet_sample(
+        path: str,
+        *,
+        sample_fraction: Optional[float] = None,
+        shard: Optional[Tuple[int, int]] = None,
+        columns: Optional[List[str]] = None,
+        years: Optional[List[int]] = None
+) -> pd.DataFrame:
+    """
+    Читает parquet, оставляя при чтении только фирмы из выборки (и шарда)
+    и строки лет years. Без фильтров равносильно pd.read_parquet
+    """
+    if sample_fraction is None and shard is None and years is None:
+        return pd.read_parquet(path, columns=columns)
+
+    dataset = ds.dataset(path, format="parquet")
+    column = [item for item in dataset.schema.names if item.lower() == "inn"][0]
+    row_filter = sample_filter(column, sample_fraction, shard)
+    if years is not None:
+        year_column = [item for item in dataset.schema.names if item.lower() == "year"][0]
+        year_filter = ds.field(year_column).isin(years)
+        row_filter = year_filter if row_filter is None else row_filter & year_filter
+    return dataset.to_table(columns=columns, filter=row_filter).to_pandas()
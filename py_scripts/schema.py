@@ -0,0 +1,63 @@
+import pandas as pd
+from typing import Dict, Optional
+
+# Компактные типы колонок пайплайна (ключ - имя колонки в нижнем регистре).
+# ИНН остается int64: 10-12 знаков не помещаются в int32.
+# Стоимости и финансовые показатели остаются float64 ради точности весов и оценок.
+COMPACT_DTYPES = {
+    "inn": "int64",
+    "year": "int16",
+    "current_year": "int16",
+    "code": "int16",
+    "reporter_iso_n": "int16",
+    "product": "int32",
+    "productcode": "int32",
+    "okved": "category",
+    "okved_four": "category",
+    "country": "category",
+    "nomencode": "category",
+    "firm_id": "int32",
+    "scenario": "category",
+}
+
+# Целочисленные колонки с пропусками переводим в nullable-типы
+NULLABLE_INTS = {
+    "int16": "Int16",
+    "int32": "Int32",
+    "int64": "Int64",
+}
+
+
+def memory_mb(df: pd.DataFrame) -> float:
+    return df.memory_usage(deep=True).sum() / 2 ** 20
+
+
+def apply_schema(
+        df: pd.DataFrame,
+        *,
+        name: Optional[str] = None,
+        dtypes: Dict[str, str] = COMPACT_DTYPES
+) -> pd.DataFrame:
+    """
+    Приводит известные колонки к компактным типам, регистр имен не важен.
+    Если передано имя стадии, печатает память таблицы до и после
+    :param df: таблица
+    :param name: имя стадии для отчета о памяти
+    :param dtypes: типы колонок
+    :return: таблица с компактными типами
+    """
+    before = memory_mb(df) if name is not None else None
+
+    casts = {}
+    for col in df.columns:
+        dtype = dtypes.get(str(col).lower())
+        if dtype is None or str(df[col].dtype) in (dtype, NULLABLE_INTS.get(dtype)):
+            continue
+        if dtype in NULLABLE_INTS and df[col].isnull().any():
+            dtype = NULLABLE_INTS[dtype]
+        casts[col] = dtype
+    df = df.astype(casts)
+
+    if name is not None:
+        print("Memory of {name}: {before:.1f} MB -> {after:.1f} MB".format(name=name, before=before, after=memory_mb(df)))
+    return df
@@ -0,0 +1,153 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from typing import NamedTuple, Tuple
+
+CUBE_INDEX = "index.json"
+CUBE_ARRAYS = ["tariff", "tariff_ffill", "present", "avg_tariff"]
+TARIFF_KEYS = ["Reporter_ISO_N", "ProductCode", "current_year"]
+
+
+class TariffCube(NamedTuple):
+    # Отсортированные значения осей: позиция в массиве - индекс в кубе
+    reporters: np.ndarray
+    products: np.ndarray
+    years: np.ndarray
+    # (репортер, товар, год): исходный тариф, NaN если его нет
+    tariff: np.ndarray
+    # (репортер, товар, год): тариф, протянутый вперед по годам
+    tariff_ffill: np.ndarray
+    # (репортер, товар, год): была ли строка в таблице тарифов
+    present: np.ndarray
+    # (товар, год): средний тариф по всем репортерам
+    avg_tariff: np.ndarray
+
+
+def axis_index(index: np.ndarray, values) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Векторный аналог словаря значение -> позиция на оси куба
+    :param index: отсортированные значения оси
+    :param values: искомые значения
+    :return: позиции и маска найденных значений
+    """
+    values = np.asarray(values)
+    pos = np.searchsorted(index, values).clip(0, max(len(index) - 1, 0))
+    found = (index[pos] == values) if len(index) > 0 else np.zeros(len(values), dtype=bool)
+    return pos, found
+
+
+def ffill_last_axis(values: np.ndarray) -> np.ndarray:
+    """
+    Протягивает значения вперед по последней оси (пропуски - NaN)
+    """
+    idx = np.where(np.isnan(values), 0, np.arange(values.shape[-1]))
+    np.maximum.accumulate(idx, axis=-1, out=idx)
+    return np.take_along_axis(values, idx, axis=-1)
+
+
+def dedupe_tariffs(tariffs: pd.DataFrame) -> pd.DataFrame:
+    """
+    Оставляет одну строку тарифов на ключ (Reporter_ISO_N, ProductCode, current_year).
+    Повторы бывают, когда у страны-года несколько номенклатур HS или архивов:
+    SimpleAverage усредняется по ним (пропуски не учитываются), остальные колонки
+    берутся из первой строки. Это единое правило для всех движков инструмента
+    :param tariffs: таблица prepare_tariffs
+    :return: таблица без повторяющихся ключей, порядок строк - по первому вхождению ключа
+    """
+    duplicated = tariffs.duplicated(subset=TARIFF_KEYS)
+    if not duplicated.any():
+        return tariffs
+    print("Averaging {n} duplicate tariff rows".format(n=duplicated.sum()))
+    mean = tariffs.groupby(TARIFF_KEYS, sort=False, observed=True)["SimpleAverage"].transform("mean")
+    return tariffs.assign(SimpleAverage=mean).loc[~duplicated].reset_index(drop=True)
+
+
+def build_tariff_cube(tariffs: pd.DataFrame) -> TariffCube:
+    """
+    Строит плотный куб тарифов по таблице prepare_tariffs.
+    Повторяющиеся тарифы на один ключ усредняются (см. dedupe_tariffs)
+    :param tariffs: таблица с колонками Reporter_ISO_N, ProductCode, current_year, SimpleAverage
+    :return: куб тарифов
+    """
+    tariffs = dedupe_tariffs(tariffs)
+    keys = TARIFF_KEYS
+    reporters, products, years = [np.unique(tariffs[col].to_numpy()) for col in keys]
+
+    values = tariffs[keys + ["SimpleAverage"]]
+    pos = tuple(axis_index(index, values[col])[0] for index, col in zip([reporters, products, years], keys))
+
+    shape = (len(reporters), len(products), len(years))
+    tariff = np.full(shape, np.nan)
+    tariff[pos] = values["SimpleAverage"].to_numpy(dtype=float)
+    present = np.zeros(shape, dtype=bool)
+    present[pos] = True
+
+    # Средний тариф считается по строкам таблицы без повторов ключа, как groupby().mean()
+    avg = tariffs.groupby(["ProductCode", "current_year"])["SimpleAverage"].mean().reset_index()
+    avg_tariff = np.full(shape[1:], np.nan)
+    avg_tariff[axis_index(products, avg["ProductCode"])[0], axis_index(years, avg["current_year"])[0]] = \
+        avg["SimpleAverage"].to_numpy(dtype=float)
+
+    return TariffCube(
+        reporters=reporters,
+        products=products,
+        years=years,
+        tariff=tariff,
+        tariff_ffill=ffill_last_axis(tariff),
+        present=present,
+        avg_tariff=avg_tariff
+    )
+
+
+def save_tariff_cube(cube: TariffCube, cube_dir: str):
+    """
+    Сохраняет массивы куба в .npy (их можно открыть через mmap) и оси в index.json
+    """
+    os.makedirs(cube_dir, exist_ok=True)
+    for name in CUBE_ARRAYS:
+        np.save(os.path.join(cube_dir, "{name}.npy".format(name=name)), getattr(cube, name))
+    with open(os.path.join(cube_dir, CUBE_INDEX), "w") as f:
+        json.dump({
+            "reporters": cube.reporters.tolist(),
+            "products": cube.products.tolist(),
+            "years": cube.years.tolist()
+        }, f)
+
+
+def load_tariff_cube(cube_dir: str, mmap: bool = True) -> TariffCube:
+    """
+    Загружает куб тарифов. При mmap=True массивы не читаются в память целиком
+    """
+    with open(os.path.join(cube_dir, CUBE_INDEX)) as f:
+        index = json.load(f)
+    arrays = {
+        name: np.load(os.path.join(cube_dir, "{name}.npy".format(name=name)), mmap_mode="r" if mmap else None)
+        for name in CUBE_ARRAYS
+    }
+    return TariffCube(**{key: np.asarray(val, dtype=np.int64) for key, val in index.items()}, **arrays)
+
+
+def lookup_tariffs(cube: TariffCube, reporters, products, years, field: str = "tariff") -> np.ndarray:
+    """
+    Тарифы для массивов ключей одним fancy indexing вместо merge.
+    Для ключей вне куба возвращается NaN (для present - False)
+    :param field: tariff, tariff_ffill или present
+    """
+    rep_pos, rep_found = axis_index(cube.reporters, reporters)
+    prod_pos, prod_found = axis_index(cube.products, products)
+    year_pos, year_found = axis_index(cube.years, years)
+
+    array = getattr(cube, field)
+    found = rep_found & prod_found & year_found
+    missing = False if array.dtype == bool else np.nan
+    return np.where(found, array[rep_pos, prod_pos, year_pos], missing)
+
+
+def lookup_avg_tariff(cube: TariffCube, products, years) -> np.ndarray:
+    """
+    Средний по репортерам тариф для массивов (товар, год)
+    """
+    prod_pos, prod_found = axis_index(cube.products, products)
+    year_pos, year_found = axis_index(cube.years, years)
+    return np.where(prod_found & year_found, cube.avg_tariff[prod_pos, year_pos], np.nan)
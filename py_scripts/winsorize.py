@@ -0,0 +1,143 @@
+import json
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Tuple
+
+# Емкость уровня скетча: ошибка ранга порядка 1 / SKETCH_CAPACITY
+SKETCH_CAPACITY = 4096
+
+
+class QuantileSketch:
+    """
+    Сливаемый скетч квантилей (упрощенный KLL). Значения хранятся по уровням,
+    элемент уровня h имеет вес 2^h. Переполненный уровень сортируется,
+    и каждый второй элемент переносится на уровень выше, так что память
+    растет как capacity × log(n / capacity). Скетчи кусков и шардов сливаются
+    в скетч всей выборки
+    """
+    def __init__(self, capacity: int = SKETCH_CAPACITY, seed: int = 0):
+        self.capacity = capacity
+        self.count = 0
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def update(self, values) -> "QuantileSketch":
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        for height, items in enumerate(other.levels):
+            if height == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[height] = np.concatenate([self.levels[height], items])
+        self.count += other.count
+        self._compress()
+        return self
+
+    def _compress(self):
+        height = 0
+        while height < len(self.levels):
+            level = self.levels[height]
+            if len(level) > self.capacity:
+                level = np.sort(level)
+                # При нечетном размере один случайный элемент остается на уровне
+                keep = self.rng.integers(len(level)) if len(level) % 2 else None
+                kept = level[keep:keep + 1] if keep is not None else np.empty(0)
+                if keep is not None:
+                    level = np.delete(level, keep)
+                if height + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[height + 1] = np.concatenate([self.levels[height + 1], level[self.rng.integers(2)::2]])
+                self.levels[height] = kept
+            height += 1
+
+    def quantile(self, quantiles: List[float]) -> List[float]:
+        items = np.concatenate(self.levels)
+        if len(items) == 0:
+            return [np.nan for _ in quantiles]
+        if len(self.levels[0]) == self.count:
+            # Сжатия не было: все значения на нижнем уровне, квантили точные с интерполяцией, как Series.quantile
+            return np.quantile(self.levels[0], quantiles).tolist()
+        weights = np.concatenate([np.full(len(level), 2. ** height) for height, level in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        cum_weights = np.cumsum(weights[order])
+        pos = np.searchsorted(cum_weights, np.asarray(quantiles) * cum_weights[-1], side="left")
+        return items[order][np.minimum(pos, len(items) - 1)].tolist()
+
+
+class ExactQuantiles:
+    """
+    Точные квантили с тем же интерфейсом (для проверки скетча):
+    хранит все значения, результат совпадает с Series.quantile
+    """
+    def __init__(self):
+        self.count = 0
+        self.chunks = []
+
+    def update(self, values) -> "ExactQuantiles":
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        self.count += len(values)
+        self.chunks.append(values)
+        return self
+
+    def merge(self, other: "ExactQuantiles") -> "ExactQuantiles":
+        self.count += other.count
+        self.chunks.extend(other.chunks)
+        return self
+
+    def quantile(self, quantiles: List[float]) -> List[float]:
+        values = np.concatenate(self.chunks) if self.chunks else np.empty(0)
+        if len(values) == 0:
+            return [np.nan for _ in quantiles]
+        return np.quantile(values, quantiles).tolist()
+
+
+def make_sketches(columns: List[str], exact: bool = False) -> Dict[str, object]:
+    return {col: ExactQuantiles() if exact else QuantileSketch() for col in columns}
+
+
+def update_sketches(sketches: Dict[str, object], df: pd.DataFrame) -> Dict[str, object]:
+    """
+    Добавляет в скетчи колонки очередного куска данных
+    """
+    for col, sketch in sketches.items():
+        sketch.update(df[col].to_numpy(dtype=float))
+    return sketches
+
+
+def merge_sketches(sketches: Dict[str, object], other: Dict[str, object]) -> Dict[str, object]:
+    for col, sketch in sketches.items():
+        sketch.merge(other[col])
+    return sketches
+
+
+def sketch_cutoffs(sketches: Dict[str, object], quantiles: List[float]) -> Dict[str, Tuple[float, float]]:
+    return {col: tuple(sketch.quantile(quantiles)) for col, sketch in sketches.items()}
+
+
+def save_cutoffs(
+        cutoffs_path: str,
+        cutoffs: Dict[str, Tuple[float, float]],
+        *,
+        quantiles: List[float],
+        exact: bool
+):
+    """
+    Сохраняет использованные пороги, чтобы повторные прогоны применяли те же значения
+    """
+    with open(cutoffs_path, "w") as f:
+        json.dump({
+            "quantiles": list(quantiles),
+            "method": "exact" if exact else "sketch",
+            "cutoffs": {col: list(bounds) for col, bounds in cutoffs.items()}
+        }, f, indent=2)
+
+
+def load_cutoffs(cutoffs_path: str) -> Dict[str, Tuple[float, float]]:
+    with open(cutoffs_path) as f:
+        return {col: tuple(bounds) for col, bounds in json.load(f)["cutoffs"].items()}
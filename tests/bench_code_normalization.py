@@ -0,0 +1,104 @@
+"""
+Бенчмарк нормализации кодов стран и товаров деклараций: прежние поэлементные
+функции через Series.map против векторных process_code и process_product_code.
+Печатает время на миллион строк и проверяет совпадение результатов.
+
+    python tests/bench_code_normalization.py --n_rows 1000000
+"""
+import os
+import sys
+import time
+import fire
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from py_scripts.process_raw_customs import YUGOSLAVIA, process_code, process_product_code
+
+ISO2 = ["AB", "DE", "CN", "FR", "BY", "UA", "US", "IT", "YU", "RU"]
+NUMERIC = [40, 276, 156, 250, 112, 804, 840, 380, 499, 688, 643]
+
+
+def country_codes():
+    """
+    Справочник в формате load_country_codes: буквенный код -> цифровой и множество кодов
+    """
+    name_to_code = {name: code for name, code in zip(ISO2, [895, 276, 156, 250, 112, 804, 840, 380, 499, 643])}
+    return name_to_code, set(NUMERIC)
+
+
+def scalar_code(item, *, name_to_code, all_codes):
+    if str(item).isalpha():
+        if item == "АВ":
+            item = "AB"
+        code = name_to_code.get(item, 0)
+    else:
+        item = int(item)
+        code = item if item in all_codes else 0
+
+    return code if not code in YUGOSLAVIA else 891
+
+
+def scalar_product_code(item):
+    try:
+        item = int(item)
+        return item // 10000
+    except ValueError:
+        return None
+
+
+def scalar_codes(g17a: pd.Series, g33: pd.Series, name_to_code, all_codes):
+    func = lambda x: scalar_code(x, name_to_code=name_to_code, all_codes=all_codes)
+    return g17a.map(func).astype("int64").to_numpy(), \
+        g33.map(scalar_product_code, na_action="ignore").astype("float64").to_numpy()
+
+
+def vector_codes(g17a: pd.Series, g33: pd.Series, name_to_code, all_codes):
+    # Кириллический "АВ" добавляется в справочник один раз, как в load_country_codes
+    name_to_code = {**name_to_code, "АВ": name_to_code["AB"]}
+    return process_code(g17a, name_to_code=name_to_code, all_codes=all_codes), \
+        process_product_code(g33).to_numpy()
+
+
+def make_columns(n_rows: int, seed: int = 0):
+    """
+    Синтетические g17a и g33: буквенные и цифровые коды стран (с "АВ", Югославией
+    и неизвестными кодами), коды ТНВЭД с пробелами, ведущими нулями и мусором
+    """
+    rng = np.random.default_rng(seed)
+    countries = np.array(ISO2 + ["АВ", "ZZ"] + [str(code) for code in NUMERIC + [1, 999]], dtype=object)
+    products = rng.integers(10 ** 8, 10 ** 10, 5000).astype(str).astype(object)
+    products = np.concatenate([products, [" 0101210000", "0000000000", "+1234567890", "12AB", "1e5", ""]])
+    g33 = pd.Series(rng.choice(products, n_rows), dtype=object)
+    g33[rng.random(n_rows) < 0.01] = np.nan
+    return pd.Series(rng.choice(countries, n_rows), dtype=object), g33
+
+
+def check_equal(n_rows: int = 20000, seed: int = 0):
+    name_to_code, all_codes = country_codes()
+    g17a, g33 = make_columns(n_rows, seed)
+    expected = scalar_codes(g17a, g33, name_to_code, all_codes)
+    result = vector_codes(g17a, g33, name_to_code, all_codes)
+    np.testing.assert_array_equal(result[0], expected[0])
+    np.testing.assert_array_equal(result[1], expected[1])
+
+
+def main(n_rows: int = 1_000_000, repeats: int = 3):
+    name_to_code, all_codes = country_codes()
+    g17a, g33 = make_columns(n_rows)
+    check_equal()
+
+    timings = {}
+    for name, func in [("scalar", scalar_codes), ("vector", vector_codes)]:
+        best = np.inf
+        for _ in range(repeats):
+            start = time.perf_counter()
+            func(g17a, g33, name_to_code, all_codes)
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best * 1_000_000 / n_rows
+        print("{name}: {seconds:.3f} s per million rows".format(name=name, seconds=timings[name]))
+    print("Speedup: {ratio:.1f}x".format(ratio=timings["scalar"] / timings["vector"]))
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
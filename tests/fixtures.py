@@ -0,0 +1,114 @@
+"""
+Синтетические сырые данные для тестов: декларации GTD, справочник стран,
+Spark, Ruslana и тарифы в форматах, которые читают скрипты py_scripts
+"""
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+
+
+def make_countries(folder: str) -> str:
+    path = os.path.join(folder, "rus_countries.csv")
+    pd.DataFrame(dict(
+        RUS_ISO2=["AT", "DE", "CN", "RU", "AB", "YU", "FR", "BY"],
+        code=[40, 276, 156, 643, 895, 891, 250, 112]
+    )).to_csv(path, index=False)
+    return path
+
+
+def make_raw_gtd(folder: str, years=(2005, 2006, 2007, 2008, 2009), n_rows: int = 20000, seed: int = 0) -> str:
+    """
+    Годовые CSV деклараций gtdYYYY.csv и справочник стран в папке folder
+    :return: путь к справочнику стран
+    """
+    os.makedirs(folder, exist_ok=True)
+    countries_path = make_countries(folder)
+    rng = np.random.default_rng(seed)
+    inns = [str(item) for item in rng.integers(10 ** 9, 10 ** 9 + 3000, 2000)] + ["12ab", None, "50"]
+    for year in years:
+        df = pd.DataFrame({
+            "Unnamed: 0": range(n_rows),
+            "nd": 1,
+            "g012": 1,
+            "g15a": 1,
+            "g021": rng.choice(inns, n_rows).astype(object),
+            "g023": "x",
+            "g17a": rng.choice(["AT", "DE", "CN", "RU", "АВ", "276", "40", "499", "999", "156", "FR", "BY", None], n_rows).astype(object),
+            "g072": 1,
+            "gd1": 1,
+            "g34": 1,
+            "g33": rng.choice(["1704901000", "4016990000", None, "xx", "8471300000", "0101100000", "2709000000"], n_rows).astype(object),
+            "g46": ["{value:.1f}".format(value=value).replace(".", ",") for value in rng.random(n_rows) * 1000]
+        })
+        df.to_csv(os.path.join(folder, "gtd{year}.csv".format(year=year)), index=False)
+    return countries_path
+
+
+def make_mfn(
+        folder: str,
+        seed: int = 0,
+        countries=("AUS", "CHN", "USA", "BRA"),
+        years=(2003, 2005, 2006, 2008, 2009),
+        reporters=None,
+        products=None,
+        n_rows: int = 200
+):
+    """
+    Архивы MFN_H2_<страна>_<год>.zip с одним CSV; часть лет пропущена, чтобы архивы протягивались вперед
+    :param reporters: коды Reporter_ISO_N стран (по умолчанию 100, 101, ...)
+    :param products: коды товаров (по умолчанию 10000-10099)
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    reporters = [100 + i for i in range(len(countries))] if reporters is None else reporters
+    products = np.arange(10000, 10100) if products is None else np.asarray(products)
+    for country, reporter in zip(countries, reporters):
+        for year in years:
+            if rng.random() < 0.3:
+                continue
+            df = pd.DataFrame(dict(
+                NomenCode="H2",
+                Reporter_ISO_N=reporter,
+                Year=year,
+                ProductCode=rng.choice(products, n_rows),
+                Extra=1.0,
+                SimpleAverage=np.where(rng.random(n_rows) < .05, np.nan, rng.random(n_rows) * 20).round(2)
+            ))
+            with zipfile.ZipFile(os.path.join(folder, "MFN_H2_{c}_{y}.zip".format(c=country, y=year)), "w") as zip_ref:
+                zip_ref.writestr("DataJobID-1_{c}_{y}.CSV".format(c=country, y=year), df.to_csv(index=False))
+    with open(os.path.join(folder, "readme.txt"), "w") as f:
+        f.write("not an archive")
+
+
+def make_firms(inns, years, seed: int = 0):
+    """
+    Таблицы Spark и Ruslana для ИНН inns: пропуски лет, повторы ИНН-года в Ruslana
+    :return: (spark, ruslana)
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for inn in inns:
+        okved = rng.choice(["01.11", "15.20", "27.10", "29.56"])
+        for year in years:
+            if rng.random() < 0.9:
+                assets = rng.lognormal(10, 2)
+                rows.append(dict(
+                    INN=inn,
+                    Year=year,
+                    OKVED=okved,
+                    okved_four=okved,
+                    assets=assets,
+                    tang_assets=assets * rng.random(),
+                    profit=assets * rng.normal(0, .2),
+                    revenue=assets * rng.random(),
+                    short_debt=assets * rng.random() * .5,
+                    long_debt=assets * rng.random() * .4
+                ))
+    spark = pd.DataFrame(rows)\
+            .assign(debt=lambda x: x.short_debt + x.long_debt, okved_four=lambda x: x.okved_four.astype("category"))
+    ruslana = spark[["INN", "Year"]].rename(columns={"INN": "inn", "Year": "year"})\
+            .assign(empl=rng.integers(1, 300, len(spark)).astype(float))
+    # Фирмы с несколькими записями за год отбрасываются в load_firm_tables
+    ruslana = pd.concat([ruslana, ruslana.sample(len(ruslana) // 50, random_state=seed).assign(empl=7.0)], ignore_index=True)
+    return spark, ruslana
@@ -0,0 +1,133 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from py_scripts import construct_instrument, construct_instrument_v2
+from py_scripts.tariff_cube import TARIFF_KEYS, build_tariff_cube, dedupe_tariffs
+
+YEARS = [2005, 2006, 2007, 2008, 2009]
+SORT_KEYS = ["code", "product", "year", "okved_four"]
+
+
+@pytest.fixture
+def weights():
+    rng = np.random.default_rng(0)
+    # Страны EU и не-EU, чтобы репортер менялся внутри пары (страна, товар)
+    codes = [40, 100, 156, 250, 642, 804, 891]
+    rows = [
+        (okved, product, code, rng.random())
+        for okved in ["01.11", "15.20", "27.10"]
+        for product in range(10, 30)
+        for code in codes
+        if rng.random() < 0.6
+    ]
+    return pd.DataFrame(rows, columns=["okved_four", "product", "code", "value"])\
+            .assign(
+                weight=lambda x: x["value"] / x.groupby("okved_four")["value"].transform("sum"),
+                weight_c=lambda x: x["value"] / x.groupby(["okved_four", "code"])["value"].transform("sum"),
+                ProductCode=lambda x: x["product"].astype(int)
+            )
+
+
+@pytest.fixture
+def tariffs():
+    rng = np.random.default_rng(1)
+    # Пропуски по годам, чтобы ffill было что протягивать
+    rows = [
+        (reporter, product, year, rng.random() * 20)
+        for reporter in [156, 250, 642, 804, 891, 918, 100]
+        for product in range(10, 30)
+        for year in YEARS
+        if rng.random() < 0.5
+    ]
+    return pd.DataFrame(rows, columns=["Reporter_ISO_N", "ProductCode", "current_year", "SimpleAverage"])
+
+
+def loop_instrument_table(weights, tariffs, years_of_interest):
+    """
+    Прежняя реализация: ffill по циклу групп (страна, товар) и pd.concat
+    """
+    result = []
+    for year in years_of_interest:
+        df = weights.assign(current_year=year)
+        df = df.assign(Reporter_ISO_N=df["code"].map(
+            lambda code: 918 if year >= construct_instrument.EU_DICT.get(code, 10 ** 9) else code
+        ))
+        result.append(df)
+    df = pd.concat(result).merge(tariffs, on=["Reporter_ISO_N", "ProductCode", "current_year"], how="left")
+
+    result = []
+    for _, item_df in df.groupby(["code", "product"]):
+        item_df = item_df.sort_values(by=["current_year"])\
+                    .assign(SimpleAverage=lambda x: x.SimpleAverage.ffill())
+        result.append(item_df)
+    df = pd.concat(result)
+
+    return df.assign(year=lambda x: x["current_year"], tariff=lambda x: x["SimpleAverage"])\
+            [["okved_four", "product", "code", "year", "value", "weight", "weight_c", "tariff"]]
+
+
+def sorted_table(df):
+    return df.sort_values(by=SORT_KEYS, ignore_index=True)
+
+
+def test_grouped_ffill_matches_loop(weights, tariffs):
+    expected = loop_instrument_table(weights, tariffs, YEARS)
+    result = construct_instrument.prepare_instrument_table(weights, tariffs, YEARS)
+
+    pd.testing.assert_frame_equal(sorted_table(result), sorted_table(expected), check_dtype=False)
+    # Пары (страна, товар) идут в том же порядке, что и группы цикла
+    pairs = lambda df: df[["code", "product"]].drop_duplicates().to_numpy()
+    np.testing.assert_array_equal(pairs(result), pairs(expected))
+
+
+def test_tariff_matrix_matches_loop(weights, tariffs):
+    expected = loop_instrument_table(weights, tariffs, YEARS)
+    cube = build_tariff_cube(tariffs)
+    result = construct_instrument_v2.prepare_instrument_table(weights, cube, YEARS)
+
+    pd.testing.assert_frame_equal(
+        sorted_table(result.drop(columns="avg_tariff")),
+        sorted_table(expected),
+        check_dtype=False
+    )
+
+
+@pytest.fixture
+def duplicated_tariffs(tariffs):
+    # Вторая номенклатура HS для части ключей: другой тариф на тот же (репортер, товар, год)
+    extra = tariffs.sample(frac=0.3, random_state=2)\
+            .assign(SimpleAverage=lambda x: x["SimpleAverage"] + 3.0)
+    extra.iloc[::5, extra.columns.get_loc("SimpleAverage")] = np.nan
+    return pd.concat([tariffs, extra], ignore_index=True)
+
+
+def instrument_by_okved(table):
+    return table\
+            .assign(instrument=lambda x: x["weight"] * x["tariff"] / 100)\
+            .assign(instrument_c=lambda x: x["weight_c"] * x["tariff"] / 100)\
+            .groupby(["okved_four", "year"])[["instrument", "instrument_c"]].sum()
+
+
+def test_dedupe_tariffs_averages_duplicate_keys(duplicated_tariffs):
+    result = dedupe_tariffs(duplicated_tariffs)
+    expected = duplicated_tariffs.groupby(TARIFF_KEYS)["SimpleAverage"].mean()
+
+    assert not result.duplicated(subset=TARIFF_KEYS).any()
+    pd.testing.assert_series_equal(result.set_index(TARIFF_KEYS)["SimpleAverage"].sort_index(), expected)
+
+
+def test_engines_agree_on_duplicate_keys(weights, duplicated_tariffs):
+    expected = loop_instrument_table(weights, dedupe_tariffs(duplicated_tariffs), YEARS)
+    cube = build_tariff_cube(duplicated_tariffs)
+
+    v1 = construct_instrument.prepare_instrument_table(weights, duplicated_tariffs, YEARS)
+    v2 = construct_instrument_v2.prepare_instrument_table(weights, cube, YEARS)
+    # Одна строка на ключ во всех движках
+    assert len(v1) == len(v2) == len(weights) * len(YEARS)
+    pd.testing.assert_frame_equal(sorted_table(v1), sorted_table(expected), check_dtype=False)
+    pd.testing.assert_frame_equal(sorted_table(v2.drop(columns="avg_tariff")), sorted_table(expected), check_dtype=False)
+
+    sparse = construct_instrument_v2.compute_instrument_sparse(weights, cube, YEARS)\
+            .set_index(["okved_four", "year"])
+    pd.testing.assert_frame_equal(sparse, instrument_by_okved(v1), check_dtype=False, check_index_type=False)
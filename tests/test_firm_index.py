@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from py_scripts.firm_index import add_firm_id, build_firm_index, sorted_merge
+
+
+def firm_table(seed, n_rows, value_col, unique=True):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "firm_id": rng.integers(0, 200, n_rows).astype("int32"),
+        "year": rng.integers(2004, 2010, n_rows).astype("int16"),
+        value_col: rng.random(n_rows)
+    })
+    if unique:
+        df = df.drop_duplicates(subset=["firm_id", "year"])
+    return df.sort_values(by=["firm_id", "year"], kind="stable", ignore_index=True)
+
+
+@pytest.mark.parametrize("how", ["inner", "left", "outer"])
+def test_sorted_merge_matches_merge(how):
+    # В левой таблице есть повторы ключа, как в Spark
+    left = firm_table(0, 600, "assets", unique=False).assign(okved_four="01.11")
+    right = firm_table(1, 400, "empl")
+
+    result = sorted_merge(left, right, how=how)
+    expected = left.merge(right, on=["firm_id", "year"], how=how)
+
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_sorted_merge_requires_sorted_tables():
+    left = firm_table(0, 100, "assets")
+    with pytest.raises(ValueError):
+        sorted_merge(left.iloc[::-1], firm_table(1, 100, "empl"))
+
+
+def test_add_firm_id_sorts_by_firm_and_year():
+    df = pd.DataFrame({"inn": [30, 10, 20, 10], "year": [2005, 2006, 2005, 2005], "value": [1.0, 2.0, 3.0, 4.0]})
+    index = build_firm_index(df["inn"].to_numpy())
+
+    result = add_firm_id(df, index)
+
+    assert result["inn"].tolist() == [10, 10, 20, 30]
+    assert result["year"].tolist() == [2005, 2006, 2005, 2005]
+    assert result["firm_id"].tolist() == [0, 0, 1, 2]
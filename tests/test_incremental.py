@@ -0,0 +1,147 @@
+import shutil
+import pandas as pd
+import pytest
+
+from fixtures import make_firms, make_mfn, make_raw_gtd
+from py_scripts import construct_instrument_v2, firm_index, prepare_data_simple_v1, prepare_tariffs, process_raw_customs
+
+YEARS = [2005, 2006, 2007, 2008, 2009, 2010]
+# Страны деклараций фикстуры: EU (918), Китай, Беларусь, Югославия, Абхазия
+REPORTERS = {"EUN": 918, "CHN": 156, "BLR": 112, "YUG": 891, "ABH": 895}
+PRODUCTS = [170490, 401699, 847130, 10110, 270900]
+
+
+@pytest.fixture(scope="module")
+def sources(tmp_path_factory):
+    """
+    Сырые декларации за все годы, тарифы и таблицы Spark и Ruslana с 2004 года
+    """
+    folder = tmp_path_factory.mktemp("sources")
+    countries_path = make_raw_gtd(str(folder / "raw"), years=YEARS, n_rows=3000, seed=3)
+    make_mfn(
+        str(folder / "mfn"),
+        countries=list(REPORTERS),
+        reporters=list(REPORTERS.values()),
+        products=PRODUCTS,
+        years=[2003, 2005, 2006, 2008, 2009, 2010],
+        n_rows=20
+    )
+    inns = sorted({
+        int(inn) for year in YEARS
+        for inn in pd.read_csv(folder / "raw" / "gtd{year}.csv".format(year=year), dtype=str)["g021"].dropna()
+        if inn.isdigit() and int(inn) > 100
+    })
+    spark, ruslana = make_firms(inns[::2] + list(range(2 * 10 ** 9, 2 * 10 ** 9 + 300)), range(2004, YEARS[-1] + 1), seed=1)
+    return dict(folder=folder, countries_path=countries_path, spark=spark, ruslana=ruslana)
+
+
+def build(sources, folder, raw_years, update_years=None, index_path=None):
+    """
+    Все стадии пайплайна над сырыми декларациями raw_years: полная сборка
+    или обновление лет update_years поверх выходов прошлой сборки в folder
+    """
+    raw = folder / "raw"
+    raw.mkdir(parents=True, exist_ok=True)
+    for year in raw_years:
+        shutil.copy(sources["folder"] / "raw" / "gtd{year}.csv".format(year=year), raw)
+    last_year = max(raw_years)
+    sources["spark"].loc[lambda x: x["Year"] <= last_year].to_parquet(folder / "spark.parquet", index=False)
+    sources["ruslana"].loc[lambda x: x["year"] <= last_year].to_parquet(folder / "ruslana.parquet", index=False)
+
+    process_raw_customs.main(
+        str(raw), str(folder / "gtd"), partitioned=True, years=update_years, countries_path=sources["countries_path"]
+    )
+    prepare_tariffs.main(
+        str(sources["folder"] / "mfn"),
+        str(folder / "tariffs.parquet"),
+        streaming=True,
+        cube_path=str(folder / "cube"),
+        gtd_path=str(raw)
+    )
+    if index_path is None:
+        index_path = folder / "firm_index.parquet"
+        firm_index.main(
+            str(folder / "spark.parquet"), str(folder / "ruslana.parquet"), str(folder / "gtd"), str(index_path),
+            years=update_years
+        )
+    for engine, output in [("long", "iv.parquet"), ("sparse", "iv_sparse.parquet")]:
+        construct_instrument_v2.main(
+            str(folder / "spark.parquet"),
+            str(folder / "gtd"),
+            str(folder / "tariffs.parquet"),
+            str(folder / output),
+            engine=engine,
+            cube_path=str(folder / "cube"),
+            update_years=update_years
+        )
+    prepare_data_simple_v1.main(
+        str(folder / "spark.parquet"),
+        str(folder / "ruslana.parquet"),
+        str(folder / "gtd"),
+        str(folder / "iv.parquet"),
+        str(folder / "final.csv"),
+        firm_index_path=str(index_path),
+        update_years=update_years
+    )
+
+
+def test_update_matches_full_build(sources, tmp_path):
+    # Сборка 2005-2008, затем два обновления подряд: 2009 и 2010
+    incremental = tmp_path / "incremental"
+    build(sources, incremental, YEARS[:4])
+    build(sources, incremental, YEARS[:5], update_years=2009)
+    build(sources, incremental, YEARS, update_years=2010)
+
+    # Полная сборка тех же данных с тем же индексом фирм (новые ИНН получают номера по мере появления)
+    full = tmp_path / "full"
+    build(sources, full, YEARS, index_path=incremental / "firm_index.parquet")
+
+    for name in ["iv.parquet", "iv_sparse.parquet"]:
+        result = pd.read_parquet(incremental / name)
+        assert sorted(result["year"].unique()) == YEARS
+        pd.testing.assert_frame_equal(result, pd.read_parquet(full / name))
+    pd.testing.assert_frame_equal(
+        prepare_data_simple_v1.load_merged_table(str(incremental / "final_merged")),
+        prepare_data_simple_v1.load_merged_table(str(full / "final_merged"))
+    )
+    with open(incremental / "final.csv") as result, open(full / "final.csv") as expected:
+        assert result.read() == expected.read()
+    assert 2010 in set(pd.read_csv(full / "final.csv")["year"])
+
+
+def test_instrument_refuses_years_missing_from_tariffs(sources, tmp_path):
+    build(sources, tmp_path, YEARS)
+    # Куб без 2010 года: ffill иначе молча скопировал бы тарифы 2009 года
+    prepare_tariffs.main(
+        str(sources["folder"] / "mfn"),
+        str(tmp_path / "old_tariffs.parquet"),
+        years_of_interest=YEARS[:-1],
+        streaming=True,
+        cube_path=str(tmp_path / "old_cube")
+    )
+    with pytest.raises(ValueError, match="No tariffs for years \\[2010\\]"):
+        construct_instrument_v2.main(
+            str(tmp_path / "spark.parquet"),
+            str(tmp_path / "gtd"),
+            str(tmp_path / "old_tariffs.parquet"),
+            str(tmp_path / "iv.parquet"),
+            cube_path=str(tmp_path / "old_cube"),
+            update_years=2010
+        )
+
+
+def test_instrument_years_follow_tariff_cube(sources, tmp_path):
+    build(sources, tmp_path, YEARS)
+    # Декларации базового года одним файлом, как в старом Makefile: годы инструмента берутся из куба
+    (tmp_path / "flat").mkdir()
+    process_raw_customs.main(
+        str(tmp_path / "raw"), str(tmp_path / "flat"), years=2005, countries_path=sources["countries_path"]
+    )
+    construct_instrument_v2.main(
+        str(tmp_path / "spark.parquet"),
+        str(tmp_path / "flat" / "gtd2005.parquet"),
+        str(tmp_path / "tariffs.parquet"),
+        str(tmp_path / "iv_single.parquet"),
+        cube_path=str(tmp_path / "cube")
+    )
+    pd.testing.assert_frame_equal(pd.read_parquet(tmp_path / "iv_single.parquet"), pd.read_parquet(tmp_path / "iv.parquet"))
@@ -0,0 +1,36 @@
+from py_scripts import pipeline
+
+
+def test_customs_stage_hashes_the_countries_file_it_reads():
+    stage = [stage for stage in pipeline.make_stages("data") if stage.name == "process_raw_customs"][0]
+    assert stage.params["countries_path"] in stage.inputs
+
+
+def test_sampled_stages_do_not_overwrite_full_outputs():
+    full = {stage.name: stage for stage in pipeline.make_stages("data")}
+    sampled = {stage.name: stage for stage in pipeline.make_stages("data", sample_fraction=0.01)}
+
+    for name, stage in sampled.items():
+        if "sample_fraction" in stage.params:
+            assert not set(stage.outputs) & set(full[name].outputs)
+            assert pipeline.state_key(stage) != pipeline.state_key(full[name])
+        else:
+            assert stage.outputs == full[name].outputs
+    # Стадия после инструмента читает инструмент той же выборки
+    assert sampled["prepare_data_simple"].params["iv_path"] == sampled["construct_instrument"].params["output_path"]
+    assert pipeline.stage_dependencies(list(sampled.values()))["prepare_data_simple"] >= {"construct_instrument"}
+
+
+def test_tariff_years_follow_raw_declarations(tmp_path):
+    raw = tmp_path / "gtd" / "gtd2005-2009"
+    raw.mkdir(parents=True)
+    for year in [2005, 2006, 2010]:
+        (raw / "gtd{year}.csv".format(year=year)).write_text("")
+
+    stage = [stage for stage in pipeline.make_stages(str(tmp_path)) if stage.name == "prepare_tariffs"][0]
+    assert stage.params["years_of_interest"] == [2005, 2006, 2010]
+    # Новый год меняет отпечаток стадии тарифов
+    before = pipeline.stage_fingerprint(stage, {})
+    (raw / "gtd2011.csv").write_text("")
+    stage = [stage for stage in pipeline.make_stages(str(tmp_path)) if stage.name == "prepare_tariffs"][0]
+    assert pipeline.stage_fingerprint(stage, {}) != before
@@ -0,0 +1,115 @@
+import os
+import zipfile
+import pandas as pd
+import pytest
+
+from fixtures import make_mfn
+from py_scripts import prepare_tariffs
+
+YEARS = [2005, 2006, 2007, 2008, 2009]
+COLS = ["NomenCode", "Reporter_ISO_N", "Year", "ProductCode", "SimpleAverage"]
+
+
+def per_year_reference(folder):
+    """
+    Для каждой страны и года читает последний архив не позже этого года
+    """
+    archives = prepare_tariffs.scan_archives(folder)
+    result = []
+    for country, item_df in archives.groupby("country"):
+        for year in YEARS:
+            available = item_df.loc[item_df["year"] <= year]
+            if len(available) == 0:
+                continue
+            zip_path = available.sort_values(by="year")["zip_path"].iloc[-1]
+            with zipfile.ZipFile(zip_path) as zip_ref:
+                csv_file = zip_ref.namelist()[0]
+            result.append(
+                prepare_tariffs.read_tariff_csv(csv_file, zip_path, cols=COLS).assign(country=country, current_year=year)
+            )
+    return pd.concat(result, ignore_index=True)
+
+
+def normalized(df):
+    df = df.loc[:, COLS + ["country", "current_year"]].astype({"current_year": int})
+    return df.sort_values(by=list(df.columns), ignore_index=True)
+
+
+def test_streaming_load_matches_per_year_read(tmp_path):
+    make_mfn(tmp_path / "mfn")
+    for workers in [1, 2]:
+        df, _ = prepare_tariffs.download_tariffs(
+            str(tmp_path / "mfn"), years_of_interest=YEARS, streaming=True, workers=workers
+        )
+        pd.testing.assert_frame_equal(normalized(df), normalized(per_year_reference(str(tmp_path / "mfn"))))
+
+
+def test_load_tariffs_without_files_returns_empty_frame():
+    meta_data = pd.DataFrame(columns=["HS_standard", "country", "year", "filename", "zip_path", "csv_file"])
+    df, _ = prepare_tariffs.load_tariffs(meta_data, years_of_interest=YEARS, cols=COLS, streaming=True)
+    assert len(df) == 0
+    assert list(df.columns) == COLS + ["country", "current_year"]
+
+
+def run_main(folder, target_path, **kwargs):
+    kwargs = {"years_of_interest": YEARS, **kwargs} if "gtd_path" not in kwargs else kwargs
+    prepare_tariffs.main(str(folder), str(target_path), streaming=True, **kwargs)
+    return normalized(pd.read_parquet(target_path))
+
+
+def test_incremental_update_matches_full_build(tmp_path):
+    folder = tmp_path / "mfn"
+    make_mfn(folder, seed=0)
+    run_main(folder, tmp_path / "inc.parquet", incremental=True)
+
+    # Новая страна и замененный архив: перечитываются только их страны
+    make_mfn(folder, seed=1, countries=("DEU",))
+    os.remove(folder / sorted(name for name in os.listdir(folder) if name.startswith("MFN_H2_AUS"))[0])
+    incremental = run_main(folder, tmp_path / "inc.parquet", incremental=True)
+
+    pd.testing.assert_frame_equal(incremental, run_main(folder, tmp_path / "full.parquet"))
+
+
+def test_incremental_skips_archives_without_required_columns(tmp_path):
+    folder = tmp_path / "mfn"
+    make_mfn(folder)
+    with zipfile.ZipFile(folder / "MFN_H2_FRA_2006.zip", "w") as zip_ref:
+        zip_ref.writestr("FRA.CSV", pd.DataFrame({"Reporter_ISO_N": [250], "Year": [2006]}).to_csv(index=False))
+
+    df = run_main(folder, tmp_path / "tariffs.parquet", incremental=True)
+    assert "FRA" not in set(df["country"])
+    manifest = pd.read_parquet(tmp_path / "tariffs_manifest.parquet")
+    assert manifest.loc[manifest["country"] == "FRA", "columns"].iloc[0] == "Reporter_ISO_N,Year"
+
+
+def test_incremental_without_archives_raises(tmp_path):
+    (tmp_path / "mfn").mkdir()
+    with pytest.raises(ValueError, match="No tariff archives"):
+        run_main(tmp_path / "mfn", tmp_path / "tariffs.parquet", incremental=True)
+    assert not os.path.exists(tmp_path / "tariffs.parquet")
+
+
+def test_years_follow_raw_declarations(tmp_path):
+    make_mfn(tmp_path / "mfn")
+    (tmp_path / "gtd").mkdir()
+    for year in YEARS + [2010]:
+        (tmp_path / "gtd" / "gtd{year}.csv".format(year=year)).write_text("")
+
+    df = run_main(tmp_path / "mfn", tmp_path / "tariffs.parquet", gtd_path=str(tmp_path / "gtd"))
+    assert sorted(df["current_year"].unique()) == YEARS + [2010]
+
+    # Без years_of_interest и gtd_path CLI работает как раньше: годы 2005-2009
+    prepare_tariffs.main(str(tmp_path / "mfn"), str(tmp_path / "default.parquet"), streaming=True)
+    assert sorted(pd.read_parquet(tmp_path / "default.parquet")["current_year"].unique()) == YEARS
+
+
+def test_incremental_reloads_all_countries_when_years_change(tmp_path):
+    folder = tmp_path / "mfn"
+    make_mfn(folder)
+    run_main(folder, tmp_path / "inc.parquet", incremental=True)
+
+    # Архивы не менялись, но добавился год: таблица должна совпасть с полной сборкой
+    years = YEARS + [2010]
+    incremental = run_main(folder, tmp_path / "inc.parquet", incremental=True, years_of_interest=years)
+    pd.testing.assert_frame_equal(incremental, run_main(folder, tmp_path / "full.parquet", years_of_interest=years))
+    assert 2010 in set(incremental["current_year"])
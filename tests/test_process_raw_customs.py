@@ -0,0 +1,59 @@
+import os
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from bench_code_normalization import check_equal
+from fixtures import make_raw_gtd
+from py_scripts import process_raw_customs
+
+
+def test_vector_codes_match_scalar():
+    check_equal(n_rows=20000, seed=0)
+    check_equal(n_rows=5000, seed=1)
+
+
+def test_main_reads_countries_path(tmp_path):
+    countries_path = make_raw_gtd(str(tmp_path / "raw"), years=(2005,), n_rows=2000)
+    os.makedirs(tmp_path / "gtd")
+    process_raw_customs.main(str(tmp_path / "raw"), str(tmp_path / "gtd"), partitioned=True, years=2005, countries_path=countries_path)
+
+    df = pd.read_parquet(tmp_path / "gtd")
+    # Только коды из справочника, без России и неизвестных стран
+    assert set(df["code"]) <= {40, 276, 156, 895, 891, 250, 112}
+    assert len(df) > 0
+
+    # Без справочника по пути по умолчанию скрипт падает, а не берет чужой файл
+    with pytest.raises(FileNotFoundError):
+        process_raw_customs.main(str(tmp_path / "raw"), str(tmp_path / "gtd"), partitioned=True, years=2005,
+                                 countries_path=str(tmp_path / "missing.csv"))
+
+
+def row_group_inn_ranges(parquet_path):
+    metadata = pq.ParquetFile(parquet_path).metadata
+    column = metadata.schema.names.index("INN")
+    return [
+        (metadata.row_group(i).column(column).statistics.min, metadata.row_group(i).column(column).statistics.max)
+        for i in range(metadata.num_row_groups)
+    ]
+
+
+def test_streaming_partition_is_sorted_as_a_whole(tmp_path, monkeypatch):
+    countries_path = make_raw_gtd(str(tmp_path / "raw"), years=(2006,), n_rows=20000)
+    monkeypatch.setattr(process_raw_customs, "ROW_GROUP_SIZE", 3000)
+    # Мелкие row group-ы серий: слияние много раз подчитывает каждую серию
+    monkeypatch.setattr(process_raw_customs, "MERGE_BATCH_ROWS", 300)
+    for name, chunksize in [("full", None), ("stream", 4000)]:
+        os.makedirs(tmp_path / name)
+        process_raw_customs.main(str(tmp_path / "raw"), str(tmp_path / name), chunksize=chunksize,
+                                 partitioned=True, years=2006, countries_path=countries_path)
+
+    partition = os.path.join("year=2006", "part-0.parquet")
+    ranges = row_group_inn_ranges(tmp_path / "stream" / partition)
+    assert len(ranges) > 1
+    assert os.listdir(tmp_path / "stream" / "year=2006") == ["part-0.parquet"]
+    # Row group-ы не пересекаются по INN
+    assert all(prev[1] <= cur[0] for prev, cur in zip(ranges, ranges[1:]))
+
+    read = lambda name: pd.read_parquet(tmp_path / name / partition)
+    pd.testing.assert_frame_equal(read("stream"), read("full"), check_dtype=False)
@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from py_scripts import process_raw_spark
+
+
+def write_spark_csv(path, n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "Source": rng.choice(["CUR", "OLD"], n_rows),
+        "INN": rng.integers(10 ** 9, 10 ** 9 + 500, n_rows).astype(float),
+        "OKVED": rng.choice(["01.11 x", "15.20", "27.10"], n_rows),
+        "Year": rng.integers(2004, 2010, n_rows),
+        **{col: rng.lognormal(5, 1, n_rows) for col in process_raw_spark.COLUMNS if col.startswith("Form_")}
+    })
+    df.to_csv(path, sep=";", index=False)
+    return df
+
+
+def test_arrow_engine_matches_pandas(tmp_path):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    write_spark_csv(raw / "a.csv", 3000, seed=0)
+    write_spark_csv(raw / "b.csv", 3000, seed=1)
+    # Файл без нужных колонок пропускается обоими движками
+    pd.DataFrame({"Source": ["CUR"], "INN": [1.0], "Year": [2007]}).to_csv(raw / "broken.csv", sep=";", index=False)
+
+    process_raw_spark.main(str(raw), str(tmp_path / "pandas.parquet"))
+    process_raw_spark.main(str(raw), str(tmp_path / "arrow.parquet"), engine="arrow", workers=2)
+
+    key = ["INN", "Year", "assets"]
+    read = lambda name: pd.read_parquet(tmp_path / name).astype({"okved_four": str})\
+            .sort_values(by=key, ignore_index=True)
+    pd.testing.assert_frame_equal(read("arrow.parquet"), read("pandas.parquet"), check_dtype=False)
+
+
+def test_arrow_engine_failure_mid_file_keeps_previous_output(tmp_path):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    # Ошибка разбора далеко за первым блоком чтения (1 MB): часть батчей уже записана
+    df = write_spark_csv(raw / "a.csv", 30000)
+    with open(raw / "a.csv", "a") as f:
+        f.write(";".join(["CUR", "1000000001", "15.20", "2007"] + ["not_a_number"] * (len(df.columns) - 4)) + "\n")
+    assert os.path.getsize(raw / "a.csv") > 2 * 2 ** 20
+
+    output = tmp_path / "spark.parquet"
+    pd.DataFrame({"marker": [1]}).to_parquet(output)
+    with pytest.raises(Exception):
+        process_raw_spark.main(str(raw), str(output), engine="arrow", workers=1)
+
+    assert pd.read_parquet(output).columns.tolist() == ["marker"]
+    assert sorted(os.listdir(tmp_path)) == ["raw", "spark.parquet"]
+
+
+def test_arrow_engine_fails_on_bad_value_before_first_write(tmp_path):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    # Десятичная запятая в первой строке: файл падает до первого записанного батча
+    df = write_spark_csv(raw / "a.csv", 100)
+    df.astype({"Form_1_Field_300": object}).assign(Form_1_Field_300=lambda x: x["Form_1_Field_300"].where(x.index > 0, "12,5"))\
+        .to_csv(raw / "a.csv", sep=";", index=False)
+
+    with pytest.raises(Exception):
+        process_raw_spark.main(str(raw), str(tmp_path / "spark.parquet"), engine="arrow", workers=1)
+    assert not os.path.exists(tmp_path / "spark.parquet")
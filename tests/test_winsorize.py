@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+
+from py_scripts.prepare_data_simple_v1 import FILTER_QUANTILES, TWO_SIDED_COLS, UPPER_COLS, compute_cutoffs
+from py_scripts.winsorize import QuantileSketch
+
+
+def test_in_memory_cutoffs_match_series_quantile():
+    rng = np.random.default_rng(0)
+    cols = TWO_SIDED_COLS + UPPER_COLS
+    data = pd.DataFrame({col: rng.lognormal(size=1000) for col in cols})
+
+    cutoffs = compute_cutoffs(data)
+    for col in cols:
+        assert cutoffs[col] == tuple(data[col].quantile(FILTER_QUANTILES))
+    # Строк строго внутри порогов столько же, сколько при отсечении по Series.quantile
+    left, right = cutoffs["assets"]
+    assert data["assets"].between(left, right, inclusive="neither").sum() == 980
+
+
+def test_sketch_is_exact_until_compressed():
+    values = np.random.default_rng(1).random(1000)
+    sketch = QuantileSketch(capacity=4096).update(values[:600]).update(values[600:])
+    assert sketch.quantile(FILTER_QUANTILES) == np.quantile(values, FILTER_QUANTILES).tolist()
+
+    # После сжатия ошибка ранга порядка 1 / capacity
+    values = np.random.default_rng(2).random(200_000)
+    sketch = QuantileSketch(capacity=1024).update(values)
+    ranks = np.searchsorted(np.sort(values), sketch.quantile(FILTER_QUANTILES)) / len(values)
+    assert np.abs(ranks - FILTER_QUANTILES).max() < 0.01